@@ -0,0 +1,125 @@
+"""
+Module building the analysis tables from the predicted entropies of the utterances:\
+the mean of each metric by family, speaker and age, merged with the kideval metrics.
+"""
+from typing import Union, Optional
+from argparse import ArgumentParser
+from pathlib import Path
+import os
+import pandas as pd
+from pandas import DataFrame, Series
+from results_writer import read_results
+from manifest import read_columns
+from chat_index import ChatIndex
+
+DataPath = Union[str, Path]
+
+GROUPS = ["family", "speaker", "age"]
+SPEAKERS = {"CHI": "Target_Child", "FEM": "Mother"} # the speakers of the HuBERT results
+
+def files_ages(cha_files: Series, cha_index: ChatIndex) -> Series:
+    """Returns the age of each distinct cha file, indexed by the file."""
+    cha_files = cha_files.dropna().unique()
+    return Series([cha_index.age(cha_file) for cha_file in cha_files], index=cha_files, dtype=float)
+
+def with_informations(results: DataFrame, manifest: DataPath) -> DataFrame:
+    """Adds the family, the speaker and the age of the utterances, read from the manifest."""
+    informations = read_columns(manifest, ["utterance_id", *GROUPS])
+    return results.merge(informations, on="utterance_id")
+
+def hubert_informations(results: DataFrame, cha_index: ChatIndex) -> DataFrame:
+    """
+    Adds the family and the age of the utterances of the HuBERT results, given by\
+    the names of their files, and renames their speakers. The files whose age is\
+    unknown (0) are dropped.
+    """
+    names = results["file_name"].drop_duplicates()
+    families, cha_files = [], []
+    for name in map(Path, names):
+        child, filename = name.stem.split("-") if "-" in name.stem else (name.parent.stem, name.stem)
+        families.append(child)
+        cha_files.append(f"{child}/{filename}.cha")
+    files = DataFrame({"file_name": names.to_numpy(), "family": families, "cha_file": cha_files})
+    files["age"] = files["cha_file"].map(files_ages(files["cha_file"], cha_index))
+    files = files.loc[files["age"] != 0.0, ["file_name", "family", "age"]]
+    results = results.merge(files, on="file_name")
+    results["speaker"] = results.pop("segment_speaker").replace(SPEAKERS)
+    return results[results["speaker"].isin(SPEAKERS.values())]
+
+def aggregate(results: DataFrame) -> DataFrame:
+    """Averages the metrics of the utterances by family, speaker and age."""
+    return results.groupby(GROUPS).mean(numeric_only=True)
+
+def kideval_ages(metrics: DataFrame, cha_index: ChatIndex) -> DataFrame:
+    """
+    Prepares the kideval metrics by adding a family column and replacing\
+    the ages in whole months by the ages of the cha files, when known.
+    """
+    metrics = metrics.rename(columns={"Age(Month)": "age"})
+    metrics["family"] = metrics["File"].str.split("/").str[0]
+    ages = metrics["File"].map(files_ages(metrics["File"], cha_index))
+    metrics["age"] = ages.where(ages.notna() & (ages != 0.0), metrics["age"])
+    return metrics
+
+def read_kideval(kideval_csv: DataPath, cha_index: ChatIndex) -> DataFrame:
+    """Reads the kideval metrics and prepares them for merging."""
+    return kideval_ages(pd.read_csv(kideval_csv, sep=";"), cha_index)
+
+def merge_kideval(table: DataFrame, metrics: DataFrame) -> DataFrame:
+    """
+    Merges the analysis table of the target children, with the family,\
+    the speaker and the age as columns, with the kideval metrics.
+    """
+    table = table[table["speaker"] == "Target_Child"]
+    return table.merge(metrics, on=["family", "age"])
+
+def build_table(results_path: DataPath,
+                manifest: Optional[DataPath]=None,
+                cha_index: Optional[ChatIndex]=None) -> DataFrame:
+    """
+    Builds the analysis table of a results file. The HuBERT results are recognized\
+    by their `file_name` column and need the index of the cha files, the others\
+    need the manifest of the corpus.
+    """
+    results = read_results(results_path)
+    if "file_name" in results.columns:
+        assert cha_index is not None, "The HuBERT results need the cha files of the Providence corpus."
+        results = hubert_informations(results.drop(columns="Unnamed: 0", errors="ignore"), cha_index)
+    else:
+        results = with_informations(results, manifest)
+    return aggregate(results)
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("-i", "--input_csv",
+                        help="The CSV (or parquet) containing the predicted entropies.",
+                        required=True)
+    parser.add_argument("-m", "--manifest",
+                        help="The manifest of the corpus of the utterances.",
+                        default="data/Providence/model_inputs/Providence.manifest.parquet")
+    parser.add_argument("-c", "--childes_providence",
+                        help="Path to childes providence corpus. Needed for the HuBERT results\
+                            and for merging the kideval metrics.")
+    parser.add_argument("-k", "--kideval",
+                        help="The kideval metrics, merged when the childes corpus is given.",
+                        default="extra/chi.kideval.csv")
+    parser.add_argument("-j", "--jobs",
+                        help="The number of processes indexing the ages of the cha files.",
+                        type=int,
+                        default=os.cpu_count())
+
+    args = parser.parse_args()
+    output_folder = Path("results")
+    output_folder.mkdir(exist_ok=True, parents=True)
+    output_filename = f"{Path(args.input_csv).stem}_analysis"
+    cha_index = None
+    if args.childes_providence is not None:
+        cha_index = ChatIndex(Path(args.childes_providence) / "annotations" / "cha" / "raw", jobs=args.jobs)
+    table = build_table(args.input_csv, args.manifest, cha_index)
+    table.to_csv(output_folder / f"{output_filename}.csv")
+    if cha_index is not None:
+        merged = merge_kideval(table.reset_index(), read_kideval(args.kideval, cha_index))
+        merged.to_csv(output_folder / f"Metrics_{output_filename}.csv")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+"""This module implements the stores of the utterances audios read by the dataloader."""
+from typing import Union, List, Tuple, Dict, Optional
+from pathlib import Path
+from collections import defaultdict
+import os
+import logging
+import numpy as np
+import pandas as pd
+import soundfile as sf
+import h5py
+from manifest import read_columns
+
+DataPath = Union[str, Path]
+UtteranceId = str
+
+LOGGER = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+def index_path(audio_path: DataPath) -> Path:
+    """Returns the path of the index of a memory-mapped audio file."""
+    return Path(audio_path).with_suffix(".index")
+
+class H5AudioStore:
+    """
+    Reads the utterances from a h5py file storing one dataset per utterance.
+
+    Parameters
+    ----------
+    - path: str, Path
+        Path to the h5py file.
+    """
+
+    def __init__(self, path: DataPath):
+        self.path = path
+        self.h5_file = h5py.File(path, "r")
+
+    def __contains__(self, utterance_id: UtteranceId) -> bool:
+        return utterance_id in self.h5_file
+
+    def __getitem__(self, utterance_id: UtteranceId) -> np.ndarray:
+        return self.h5_file[utterance_id][:]
+
+    def sources(self) -> List[Path]:
+        """Returns the files from which the utterances are read."""
+        return [Path(self.path)]
+
+    def read(self, utterance_ids: List[UtteranceId]) -> List[np.ndarray]:
+        """Reads the samples of the given utterances."""
+        return [self[utterance_id] for utterance_id in utterance_ids]
+
+    def num_samples(self, utterance_id: UtteranceId) -> int:
+        """Returns the number of samples of a given utterance."""
+        return self.h5_file[utterance_id].shape[0]
+
+class MemmapAudioStore:
+    """
+    Reads the utterances from one flat float32 array of samples,\
+    opened with `np.memmap`. The `.index` file next to it stores\
+    the offset and the length of each utterance in the array, so\
+    the utterances are read as zero-copy slices.
+
+    Parameters
+    ----------
+    - path: str, Path
+        Path to the flat array of samples (with '.audio' as extension).
+    """
+
+    def __init__(self, path: DataPath):
+        self.path = path
+        self.index = dict()
+        with open(index_path(path), "r") as index_file:
+            for line in index_file:
+                utterance_id, offset, length = line.rstrip("\n").split("\t")
+                self.index[utterance_id] = (int(offset), int(length))
+        self.samples = np.memmap(path, dtype="float32", mode="r")
+
+    def __contains__(self, utterance_id: UtteranceId) -> bool:
+        return utterance_id in self.index
+
+    def __getitem__(self, utterance_id: UtteranceId) -> np.ndarray:
+        offset, length = self.index[utterance_id]
+        return self.samples[offset:offset + length]
+
+    def sources(self) -> List[Path]:
+        """Returns the files from which the utterances are read."""
+        return [Path(self.path), index_path(self.path)]
+
+    def read(self, utterance_ids: List[UtteranceId]) -> List[np.ndarray]:
+        """Reads the samples of the given utterances."""
+        return [self[utterance_id] for utterance_id in utterance_ids]
+
+    def num_samples(self, utterance_id: UtteranceId) -> int:
+        """Returns the number of samples of a given utterance."""
+        return self.index[utterance_id][1]
+
+class RecordingsAudioStore:
+    """
+    Reads the utterances directly from the raw recordings, so that a corpus\
+    can be scored without copying its audios first. The recording, the onset\
+    and the offset of each utterance are read from the manifest of the corpus,\
+    and only the frames of the utterances are read from the recordings.
+
+    Parameters
+    ----------
+    - path: str, Path
+        Path to the manifest of the corpus (or to its legacy `.paths` file).
+    - audio_folder: str, Path
+        The folder of the raw recordings.
+    """
+
+    def __init__(self, path: DataPath, audio_folder: DataPath):
+        self.path = path
+        self.audio_folder = Path(audio_folder)
+        segments = read_columns(path, ["utterance_id", "audio_path", "onset", "offset"])
+        # in the order of the manifest, where the utterances of a recording follow each other
+        self.ids = segments["utterance_id"].tolist()
+        self.segments: Dict[UtteranceId, Tuple[str, Optional[int], Optional[int]]] = {
+            utterance_id: (audio_path, None, None) if pd.isna(onset) else (audio_path, int(onset), int(offset))
+            for utterance_id, audio_path, onset, offset in zip(segments["utterance_id"],
+                                                               segments["audio_path"],
+                                                               segments["onset"],
+                                                               segments["offset"])}
+        self.infos: Dict[str, Tuple[int, int]] = dict()
+
+    def info(self, audio_path: str) -> Tuple[int, int]:
+        """Returns the number of frames and the sampling rate of a recording."""
+        if audio_path not in self.infos:
+            info = sf.info(str(self.audio_folder / audio_path))
+            self.infos[audio_path] = (info.frames, info.samplerate)
+        return self.infos[audio_path]
+
+    def frames(self, utterance_id: UtteranceId) -> Tuple[str, int, int]:
+        """Returns the recording of an utterance, and its first and last (excluded) frames."""
+        audio_path, onset, offset = self.segments[utterance_id]
+        frames, sampling_rate = self.info(audio_path)
+        if onset is None:
+            return audio_path, 0, frames
+        # the same rounding as when the utterances are cut at ingestion
+        start = min(int(onset / 1000 * sampling_rate), frames)
+        stop = min(int(offset / 1000 * sampling_rate), frames)
+        return audio_path, start, max(start, stop)
+
+    def __contains__(self, utterance_id: UtteranceId) -> bool:
+        return utterance_id in self.segments
+
+    def __getitem__(self, utterance_id: UtteranceId) -> np.ndarray:
+        return self.read([utterance_id])[0]
+
+    def sources(self) -> List[Path]:
+        """Returns the files from which the segments of the utterances are read."""
+        return [Path(self.path)]
+
+    def read(self, utterance_ids: List[UtteranceId]) -> List[np.ndarray]:
+        """
+        Reads the samples of the given utterances. The utterances are grouped\
+        by recording, so that each recording is opened once, and their frames\
+        are read in order after seeking to their onset.
+        """
+        recordings = defaultdict(list)
+        for idx, utterance_id in enumerate(utterance_ids):
+            audio_path, start, stop = self.frames(utterance_id)
+            recordings[audio_path].append((start, stop, idx))
+        utterances = [None] * len(utterance_ids)
+        for audio_path, segments in recordings.items():
+            with sf.SoundFile(str(self.audio_folder / audio_path)) as recording:
+                for start, stop, idx in sorted(segments):
+                    recording.seek(start)
+                    # the same dtype as the utterances copied at ingestion
+                    utterances[idx] = recording.read(stop - start)
+        return utterances
+
+    def num_samples(self, utterance_id: UtteranceId) -> int:
+        """Returns the number of samples of a given utterance."""
+        _, start, stop = self.frames(utterance_id)
+        return stop - start
+
+AudioStore = Union[H5AudioStore, MemmapAudioStore, RecordingsAudioStore]
+
+def open_audio_store(path: DataPath, audio_folder: Optional[DataPath]=None) -> AudioStore:
+    """
+    Opens the audio store of a given path, according to its extension.
+    When the folder of the recordings is given, `path` is the manifest\
+    of the corpus and the utterances are read from the recordings.
+    """
+    if audio_folder is not None:
+        return RecordingsAudioStore(path, audio_folder)
+    if Path(path).suffix == ".audio":
+        return MemmapAudioStore(path)
+    return H5AudioStore(path)
+
+class H5AudioWriter:
+    """
+    Writes the utterances into a h5py file, one dataset per utterance.
+
+    Parameters
+    ----------
+    - path: str, Path
+        Path to the h5py file.
+    - resume: bool
+        Whether to keep the utterances already written in the file. Default=False
+    """
+
+    def __init__(self, path: DataPath, resume: bool=False):
+        self.path = path
+        self.h5_file = h5py.File(path, "a" if resume else "w")
+
+    def __contains__(self, utterance_id: UtteranceId) -> bool:
+        return utterance_id in self.h5_file
+
+    def write(self, utterance_id: UtteranceId, utterance: np.ndarray) -> None:
+        """Stores the samples of a given utterance."""
+        self.h5_file.create_dataset(utterance_id, data=utterance)
+
+    def num_samples(self, utterance_id: UtteranceId) -> int:
+        """Returns the number of samples of a written utterance."""
+        return self.h5_file[utterance_id].shape[0]
+
+    def flush(self) -> None:
+        """Writes the buffered utterances to the disk."""
+        self.h5_file.flush()
+
+    def close(self) -> None:
+        """Closes the h5py file."""
+        self.h5_file.close()
+
+class MemmapAudioWriter:
+    """
+    Appends the utterances to one flat float32 array of samples\
+    and writes their offsets and lengths in the `.index` file.
+
+    Parameters
+    ----------
+    - path: str, Path
+        Path to the flat array of samples (with '.audio' as extension).
+    - resume: bool
+        Whether to keep the utterances already written. Default=False
+    """
+
+    def __init__(self, path: DataPath, resume: bool=False):
+        self.path = path
+        self.lengths = dict()
+        self.offset = 0
+        self.entries = [] # the index entries of the samples not flushed yet
+        if resume and Path(path).exists() and index_path(path).exists():
+            self.load_index()
+            mode = "a"
+        else:
+            mode = "w"
+        self.audio_file = open(path, f"{mode}b")
+        # samples written after the last complete index entry are dropped
+        self.audio_file.truncate(self.offset * np.dtype("float32").itemsize)
+        self.index_file = open(index_path(self.path), mode)
+
+    def load_index(self) -> None:
+        """
+        Reads the complete entries of the index written by a previous run.
+        The entries whose samples are not all in the audio file (after a crash,\
+        the index can reach the disk before the samples) are dropped.
+        """
+        entries = []
+        samples = os.path.getsize(self.path) // np.dtype("float32").itemsize
+        with open(index_path(self.path), "r") as index_file:
+            lines = index_file.readlines()
+        for line in lines:
+            if not line.endswith("\n"):
+                break
+            utterance_id, offset, length = line.rstrip("\n").split("\t")
+            if int(offset) + int(length) > samples:
+                break
+            entries.append(line)
+            self.lengths[utterance_id] = int(length)
+            self.offset = max(self.offset, int(offset) + int(length))
+        if len(entries) < len(lines):
+            LOGGER.info(f"{len(lines) - len(entries)} incomplete utterances of the previous run will be written again.")
+        with open(index_path(self.path), "w") as index_file:
+            index_file.write("".join(entries))
+
+    def __contains__(self, utterance_id: UtteranceId) -> bool:
+        return utterance_id in self.lengths
+
+    def write(self, utterance_id: UtteranceId, utterance: np.ndarray) -> None:
+        """Appends the samples of a given utterance."""
+        samples = np.ascontiguousarray(utterance, dtype="float32")
+        self.audio_file.write(samples.tobytes())
+        self.entries.append(f"{utterance_id}\t{self.offset}\t{len(samples)}\n")
+        self.offset += len(samples)
+        self.lengths[utterance_id] = len(samples)
+
+    def num_samples(self, utterance_id: UtteranceId) -> int:
+        """Returns the number of samples of a written utterance."""
+        return self.lengths[utterance_id]
+
+    def flush(self) -> None:
+        """
+        Writes the buffered samples to the disk, then their index entries,\
+        so that the index never refers to samples which are not written.
+        """
+        self.audio_file.flush()
+        os.fsync(self.audio_file.fileno())
+        self.index_file.write("".join(self.entries))
+        self.index_file.flush()
+        self.entries = []
+
+    def close(self) -> None:
+        """Flushes and closes the audio and the index files."""
+        self.flush()
+        self.audio_file.close()
+        self.index_file.close()
+
+def audio_writer(output_folder: Path,
+                 stem: str,
+                 audio_format: str="hdf5",
+                 resume: bool=False) -> Union[H5AudioWriter, MemmapAudioWriter]:
+    """Creates the writer of a given format ("hdf5" or "mmap")."""
+    assert audio_format in {"hdf5", "mmap"}, f"Unknown audio format {audio_format}"
+    if audio_format == "mmap":
+        return MemmapAudioWriter(output_folder / f"{stem}.audio", resume)
+    return H5AudioWriter(output_folder / f"{stem}.hdf5", resume)
@@ -0,0 +1,270 @@
+"""
+Module benchmarking the stages of the pipeline on a synthetic corpus, without\
+any network access: the audio dataset creation, the dataloader, the forward and\
+backward passes of the model, the ngram scoring and the cleaning of the utterances.
+"""
+from typing import Dict, List, Callable, Optional
+from argparse import ArgumentParser
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import json
+import platform
+import subprocess
+import time
+import logging
+import numpy as np
+import soundfile as sf
+import torch
+import transformers
+from transformers import (WhisperConfig, WhisperModel, WhisperFeatureExtractor,
+                          WhisperTokenizer, WhisperProcessor)
+from manifest import manifest_path, write_manifest
+from prepare_input_files import h5_dataset, score_utterances
+from data_loader import DataLoader
+from model import EntropyWhisper
+from utterances_cleaner_thomas import UtterancesCleaner
+
+LOGGER = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+SAMPLING_RATE = 16000
+PHONES = "a b d e f g h i j k l m n o p r s t u v w z".split()
+WORDS = ["the", "dog", "ball", "mommy", "want", "that", "look", "go", "more", "juice"]
+MARKERS = ["xxx", "&+um", "[/]", "[x 2]", "(.)", "dog@b", "0is", "<what>", "!", "?", ",", "."]
+MARKERS_JSON = Path(__file__).parent.parent / "extra" / "markers.json"
+
+def tiny_whisper(folder: Path, d_model: int=64, layers: int=2) -> Path:
+    """
+    Saves a randomly initialized whisper model, with the processor of whisper\
+    and a tokenizer of a few tokens, so that the model can be loaded offline.
+    """
+    config = WhisperConfig(d_model=d_model,
+                           encoder_layers=layers,
+                           encoder_attention_heads=2,
+                           encoder_ffn_dim=2 * d_model,
+                           decoder_layers=1,
+                           decoder_attention_heads=2,
+                           decoder_ffn_dim=2 * d_model,
+                           vocab_size=8,
+                           max_target_positions=32,
+                           pad_token_id=0,
+                           bos_token_id=1,
+                           eos_token_id=0,
+                           decoder_start_token_id=1,
+                           begin_suppress_tokens=None,
+                           suppress_tokens=None)
+    WhisperModel(config).save_pretrained(folder)
+    vocab = {token: index for index, token in enumerate(["<|endoftext|>", "<|startoftranscript|>", *"abcdeĠ"])}
+    with open(folder / "vocab.json", "w") as vocab_file:
+        json.dump(vocab, vocab_file)
+    with open(folder / "merges.txt", "w") as merges_file:
+        merges_file.write("#version: 0.2\n")
+    tokenizer = WhisperTokenizer(str(folder / "vocab.json"), str(folder / "merges.txt"))
+    WhisperProcessor(WhisperFeatureExtractor(), tokenizer).save_pretrained(folder)
+    return folder
+
+def ngram_model(path: Path, rng: np.random.Generator) -> Path:
+    """Writes a bigram model of the phones, with random probabilities, in the ARPA format."""
+    unigrams = ["<unk>", "<s>", "</s>", *PHONES]
+    bigrams = [(first, second) for first in ["<s>", *PHONES] for second in [*PHONES, "</s>"]]
+    with open(path, "w") as arpa_file:
+        arpa_file.write(f"\\data\\\nngram 1={len(unigrams)}\nngram 2={len(bigrams)}\n\n\\1-grams:\n")
+        for unigram in unigrams:
+            probability = -99 if unigram == "<s>" else np.log10(rng.uniform(0.01, 0.1))
+            arpa_file.write(f"{probability:.4f}\t{unigram}\t{np.log10(rng.uniform(0.1, 1)):.4f}\n")
+        arpa_file.write("\n\\2-grams:\n")
+        for first, second in bigrams:
+            arpa_file.write(f"{np.log10(rng.uniform(0.01, 0.5)):.4f}\t{first} {second}\n")
+        arpa_file.write("\n\\end\\\n")
+    return path
+
+def synthetic_corpus(folder: Path,
+                     utterances: int=256,
+                     recordings: int=16,
+                     seed: int=1797) -> Dict[str, object]:
+    """
+    Creates a synthetic corpus: random recordings cut into utterances,\
+    its manifest (with random texts, entropies and speakers), random phonemized\
+    utterances, CHAT-like utterances to clean, an ngram model and a tiny whisper model.
+    """
+    rng = np.random.default_rng(seed)
+    audio_folder = folder / "recordings"
+    audio_folder.mkdir(exist_ok=True, parents=True)
+    columns = {name: [] for name in ["utterance_id", "audio_path", "onset", "offset",
+                                     "text", "entropy", "family", "speaker", "age"]}
+    per_recording = -(-utterances // recordings)
+    for recording in range(recordings):
+        durations = rng.integers(500, 4000, per_recording) # in milliseconds
+        offsets = np.cumsum(durations)
+        audio = rng.uniform(-0.3, 0.3, int(offsets[-1] * SAMPLING_RATE / 1000)).astype(np.float32)
+        sf.write(audio_folder / f"recording_{recording:03d}.wav", audio, SAMPLING_RATE)
+        for index, (onset, offset) in enumerate(zip(offsets - durations, offsets)):
+            columns["utterance_id"].append(f"recording_{recording:03d}_{index:05d}")
+            columns["audio_path"].append(f"recording_{recording:03d}.wav")
+            columns["onset"].append(int(onset))
+            columns["offset"].append(int(offset))
+            columns["text"].append(" ".join(rng.choice(WORDS, rng.integers(1, 10))))
+            columns["entropy"].append(float(rng.uniform(1, 4)))
+            columns["family"].append(f"family_{recording % 4}")
+            columns["speaker"].append(str(rng.choice(["Mother", "Target_Child"])))
+            columns["age"].append(float(12 + recording))
+    manifest = manifest_path(folder, "corpus")
+    write_manifest(manifest, columns)
+    phonemized = [" ".join(rng.choice(PHONES, rng.integers(2, 40))) for _ in range(len(columns["text"]))]
+    chat_utterances = [" ".join(rng.choice(WORDS + MARKERS, rng.integers(1, 15))) for _ in range(len(columns["text"]))]
+    return {"audio_folder": audio_folder,
+            "manifest": manifest,
+            "phonemized": phonemized,
+            "chat_utterances": chat_utterances,
+            "ngram_model": ngram_model(folder / "bigrams.arpa", rng),
+            "checkpoint": tiny_whisper(folder / "whisper")}
+
+def measure(function: Callable[[], object], items: int, unit: str, repeats: int=3) -> Dict[str, object]:
+    """
+    Times a function `repeats` times (after a warm-up run), and returns\
+    its fastest and mean durations, and its throughput in `unit`.
+    """
+    function()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return {"seconds": min(timings),
+            "mean_seconds": float(np.mean(timings)),
+            "throughput": items / min(timings),
+            "unit": unit}
+
+def benchmark(folder: Path,
+              utterances: int=256,
+              batch_size: int=16,
+              repeats: int=3,
+              jobs: int=1) -> Dict[str, Dict[str, object]]:
+    """Runs the benchmarks of all the stages on a synthetic corpus created in `folder`."""
+    corpus = synthetic_corpus(folder, utterances)
+    checkpoint = str(corpus["checkpoint"])
+    inputs_folder = folder / "model_inputs"
+    results = dict()
+    for audio_format in ("hdf5", "mmap"):
+        LOGGER.info(f"Benchmarking h5_dataset ({audio_format})...")
+        results[f"h5_dataset_{audio_format}"] = measure(
+            lambda: h5_dataset(corpus["manifest"], corpus["audio_folder"], inputs_folder, audio_format, jobs),
+            len(corpus["phonemized"]), "utterances/s", repeats)
+    for frontend in ("processor", "torch"):
+        LOGGER.info(f"Benchmarking the dataloader ({frontend} frontend)...")
+        data_loader = DataLoader(inputs_folder / "corpus.hdf5",
+                                 inputs_folder / "corpus.sorted",
+                                 corpus["manifest"],
+                                 checkpoint,
+                                 frontend=frontend)
+        batches = list(data_loader.id_batches(batch_size))
+        results[f"data_loader_{frontend}"] = measure(
+            lambda: [data_loader.load_batch(batch) for batch in batches],
+            len(batches), "batches/s", repeats)
+    LOGGER.info("Benchmarking the model...")
+    model = EntropyWhisper(checkpoint)
+    mse = torch.nn.MSELoss(reduction="mean")
+    batch = data_loader.load_batch(batches[0])
+    def forward():
+        with torch.no_grad():
+            model(batch.x)
+    def forward_backward():
+        model.zero_grad()
+        mse(model(batch.x), batch.y.float()).backward()
+    results["model_forward"] = measure(forward, len(batch.y), "utterances/s", repeats)
+    results["model_forward_backward"] = measure(forward_backward, len(batch.y), "utterances/s", repeats)
+    LOGGER.info("Benchmarking the ngram scoring...")
+    results["kenlm_scoring"] = measure(
+        lambda: list(score_utterances(corpus["phonemized"], str(corpus["ngram_model"]), jobs)),
+        len(corpus["phonemized"]), "utterances/s", repeats)
+    LOGGER.info("Benchmarking the cleaner...")
+    cleaner = UtterancesCleaner(MARKERS_JSON)
+    results["utterances_cleaner"] = measure(
+        lambda: [cleaner.clean(utterance) for utterance in corpus["chat_utterances"]],
+        len(corpus["chat_utterances"]), "utterances/s", repeats)
+    return results
+
+def git_revision() -> Optional[str]:
+    """Returns the commit of the benchmarked code, if it is known."""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(report: Dict[str, object], previous_path: Path, tolerance: float=0.1) -> List[str]:
+    """
+    Compares the throughputs with those of previous results, and returns\
+    the benchmarks which are slower by more than `tolerance`.
+    """
+    with open(previous_path, "r") as previous_file:
+        previous_report = json.load(previous_file)
+    if previous_report["settings"] != report["settings"]:
+        LOGGER.warning(f"The previous results were run with other settings: {previous_report['settings']}")
+    results, previous = report["results"], previous_report["results"]
+    regressions = []
+    for name, result in results.items():
+        if name not in previous:
+            continue
+        ratio = result["throughput"] / previous[name]["throughput"]
+        LOGGER.info(f"{name}: {result['throughput']:.1f} {result['unit']} ({ratio:.2f}x the previous results)")
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("-o", "--output",
+                        help="The json file where the results are written.",
+                        default="results/benchmarks.json")
+    parser.add_argument("-n", "--utterances",
+                        help="The number of utterances of the synthetic corpus.",
+                        type=int,
+                        default=256)
+    parser.add_argument("-b", "--batch_size",
+                        help="The batch size of the dataloader and the model.",
+                        type=int,
+                        default=16)
+    parser.add_argument("-r", "--repeats",
+                        help="The number of timings of each benchmark, after a warm-up run.",
+                        type=int,
+                        default=3)
+    parser.add_argument("-j", "--jobs",
+                        help="The number of processes decoding the recordings and scoring the utterances.",
+                        type=int,
+                        default=1)
+    parser.add_argument("-w", "--work_folder",
+                        help="Where the synthetic corpus is created. Default: a temporary folder.")
+    parser.add_argument("-c", "--compare",
+                        help="Previous results to compare with.")
+    parser.add_argument("-t", "--tolerance",
+                        help="The slowdown, relative to the previous results, reported as a regression.",
+                        type=float,
+                        default=0.1)
+
+    args = parser.parse_args()
+    with TemporaryDirectory() as temporary_folder:
+        folder = Path(args.work_folder or temporary_folder)
+        folder.mkdir(exist_ok=True, parents=True)
+        results = benchmark(folder, args.utterances, args.batch_size, args.repeats, args.jobs)
+    report = {"revision": git_revision(),
+              "python": platform.python_version(),
+              "torch": torch.__version__,
+              "transformers": transformers.__version__,
+              "threads": torch.get_num_threads(),
+              "settings": {"utterances": args.utterances,
+                           "batch_size": args.batch_size,
+                           "repeats": args.repeats,
+                           "jobs": args.jobs},
+              "results": results}
+    Path(args.output).parent.mkdir(exist_ok=True, parents=True)
+    with open(args.output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+    LOGGER.info(f"The results are written in {args.output}.")
+    if args.compare is not None:
+        regressions = compare(report, Path(args.compare), args.tolerance)
+        if regressions:
+            LOGGER.warning(f"Regressions: {', '.join(regressions)}")
+
+if __name__ == "__main__":
+    main()
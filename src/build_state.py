@@ -0,0 +1,73 @@
+"""This module implements the state of an incremental build: the hashes of the sources of each output."""
+from typing import Union, Dict, Iterable, Iterator, Callable, Any, List
+from multiprocessing import Pool
+from pathlib import Path
+import hashlib
+import json
+import os
+import pandas as pd
+from pandas import DataFrame
+
+StatePath = Union[str, Path]
+Sources = Dict[str, str] # the hash of each source of an output
+
+def file_hash(path: StatePath, chunk_size: int=1 << 20) -> str:
+    """Returns the sha1 hash of the content of a file."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as source_file:
+        for chunk in iter(lambda: source_file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def rows_hash(dataframe: DataFrame) -> str:
+    """Returns a hash of the values of the rows of a DataFrame."""
+    hashes = pd.util.hash_pandas_object(dataframe, index=False)
+    return hashlib.sha1(hashes.to_numpy().tobytes()).hexdigest()
+
+class BuildState:
+    """
+    The hashes of the sources from which each output was built,\
+    so that an output is built again only when one of its sources changed.
+
+    Parameters
+    ----------
+    - path: str, Path
+        The json file storing the state.
+    """
+
+    def __init__(self, path: StatePath):
+        self.path = Path(path)
+        self.outputs: Dict[str, Sources] = dict()
+        if self.path.exists():
+            with open(self.path, "r") as state_file:
+                self.outputs = json.load(state_file)
+
+    def is_fresh(self, output: str, sources: Sources) -> bool:
+        """Whether an output was built from these very sources."""
+        return self.outputs.get(output) == sources
+
+    def record(self, output: str, sources: Sources) -> None:
+        """Records the sources of an output which was just built."""
+        self.outputs[output] = sources
+
+    def prune(self, outputs: Iterable[str]) -> List[str]:
+        """Forgets the outputs which are not built anymore, and returns them."""
+        outputs = set(outputs)
+        pruned = [output for output in self.outputs if output not in outputs]
+        self.outputs = {output: sources for output, sources in self.outputs.items() if output in outputs}
+        return pruned
+
+    def save(self) -> None:
+        """Writes the state, replaced at once so that it is never half-written."""
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        with open(f"{self.path}.tmp", "w") as state_file:
+            json.dump(self.outputs, state_file, sort_keys=True, indent=1)
+        os.replace(f"{self.path}.tmp", self.path)
+
+def run_tasks(function: Callable[[Any], Any], tasks: List[Any], jobs: int=1) -> Iterator[Any]:
+    """Runs the tasks in a pool of `jobs` processes, and yields their results as they complete."""
+    if jobs <= 1:
+        yield from map(function, tasks)
+        return
+    with Pool(jobs) as pool:
+        yield from pool.imap_unordered(function, tasks)
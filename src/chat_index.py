@@ -0,0 +1,134 @@
+"""This module implements an on-disk index of the ages and participants of the CHAT transcripts."""
+from typing import Union, Dict, Tuple, Optional
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from pathlib import Path
+import json
+import os
+import logging
+import pylangacq
+
+ChatPath = Union[str, Path]
+Entry = Dict[str, Union[int, float, Dict[str, str]]]
+
+LOGGER = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+def index_path(cha_folder: ChatPath) -> Path:
+    """Returns the path of the index of a folder of transcripts, written next to it."""
+    return Path(cha_folder).with_suffix(".index.json")
+
+def parse_headers(cha_file: Path) -> Tuple[float, Dict[str, str]]:
+    """Returns the age (in months) of a transcript and the role of each of its participants."""
+    cha = pylangacq.read_chat(str(cha_file))
+    participants = cha.headers()[0].get("Participants", dict())
+    return cha.ages(months=True)[0], {code: participant.get("role", "")
+                                      for code, participant in participants.items()}
+
+def _index_entry(cha_file: Path) -> Entry:
+    """Parses a transcript and returns its entry in the index."""
+    stat = cha_file.stat()
+    age, participants = parse_headers(cha_file)
+    return {"mtime": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "age": age,
+            "participants": participants}
+
+class ChatIndex:
+    """
+    The ages and participants of all the transcripts of a folder, so that\
+    the scripts do not parse a whole transcript each time they need its age.
+    The index is stored as json, and a transcript is parsed again only\
+    when its modification time or its size changed.
+
+    Parameters
+    ----------
+    - cha_folder: str, Path
+        The folder containing the cha files (`annotations/cha/raw`).
+    - path: str, Path
+        Where the index is stored. Default: next to the folder, see `index_path`.
+    - jobs: int
+        The number of processes parsing the transcripts. Default=1
+    """
+
+    def __init__(self, cha_folder: ChatPath, path: Optional[ChatPath]=None, jobs: int=1):
+        self.cha_folder = Path(cha_folder)
+        self.path = Path(path) if path is not None else index_path(cha_folder)
+        self.entries: Dict[str, Entry] = dict()
+        if self.path.exists():
+            with open(self.path, "r") as index_file:
+                self.entries = json.load(index_file)
+        self.update(jobs)
+
+    def key(self, cha_file: ChatPath) -> str:
+        """Returns the key of a transcript, which is its path relative to the folder."""
+        path = Path(os.path.abspath(cha_file))
+        folder = Path(os.path.abspath(self.cha_folder))
+        if folder in path.parents:
+            return path.relative_to(folder).as_posix()
+        return Path(cha_file).as_posix()
+
+    def is_stale(self, key: str) -> bool:
+        """Whether a transcript is not indexed yet or was modified since."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return True
+        stat = (self.cha_folder / key).stat()
+        return entry["mtime"] != stat.st_mtime_ns or entry["size"] != stat.st_size
+
+    def update(self, jobs: int=1) -> None:
+        """Parses the new and modified transcripts in parallel, and saves the index."""
+        keys = {self.key(cha_file) for cha_file in self.cha_folder.glob("**/*.cha")}
+        removed = set(self.entries) - keys
+        stale = sorted(key for key in keys if self.is_stale(key))
+        if not stale and not removed:
+            return
+        LOGGER.info(f"Indexing {len(stale)} transcripts ({len(keys) - len(stale)} were already indexed)...")
+        for key in removed:
+            del self.entries[key]
+        cha_files = [self.cha_folder / key for key in stale]
+        if jobs <= 1:
+            parsed = list(map(_index_entry, cha_files))
+        else:
+            with Pool(jobs) as pool:
+                parsed = pool.map(_index_entry, cha_files, chunksize=16)
+        self.entries.update(zip(stale, parsed))
+        self.save()
+
+    def save(self) -> None:
+        """Writes the index, replaced at once so that it is never half-written."""
+        with open(f"{self.path}.tmp", "w") as index_file:
+            json.dump(self.entries, index_file, sort_keys=True)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def entry(self, cha_file: ChatPath) -> Entry:
+        """Returns the entry of a transcript, given relative to the folder or not."""
+        key = self.key(cha_file)
+        if self.is_stale(key):
+            self.entries[key] = _index_entry(self.cha_folder / key)
+            self.save()
+        return self.entries[key]
+
+    def age(self, cha_file: ChatPath) -> float:
+        """Returns the age (in months) of the target child of a transcript."""
+        return self.entry(cha_file)["age"]
+
+    def participants(self, cha_file: ChatPath) -> Dict[str, str]:
+        """Returns the role of each participant of a transcript."""
+        return self.entry(cha_file)["participants"]
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("-c", "--childes_corpus",
+                        help="Folder containing the childes corpus.",
+                        required=True)
+    parser.add_argument("-j", "--jobs",
+                        help="The number of processes parsing the transcripts.",
+                        type=int,
+                        default=os.cpu_count())
+
+    args = parser.parse_args()
+    ChatIndex(Path(args.childes_corpus) / "annotations" / "cha" / "raw", jobs=args.jobs)
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,24 @@
 """Module for preparing csv containing the entropies from ngram language model."""
+from typing import Iterator
 from pathlib import Path
-from math import exp
+import numpy as np
 from pandas import DataFrame
+from results_writer import ResultsWriter
+from manifest import iter_columns
 
-def get_entropies(entropies_file: str) -> dict:
-    """Reads the entopies of utterances into dictionary."""
-    entropies_df = []
-    with open(entropies_file) as entropies:
-        for line in entropies:
-            utterance_id, entropy = line.strip().split("\t")
-            entropy = float(entropy)
-            entropies_df.append({
-                "utterance_id": utterance_id,
-                "perplexity": exp(entropy),
-                "entropy": entropy
-            })
-    return DataFrame(entropies_df)
+def get_entropies(manifest: str, chunk_size: int=100000) -> Iterator[DataFrame]:
+    """Reads the entopies of utterances by chunks of `chunk_size` utterances."""
+    for chunk in iter_columns(manifest, ["utterance_id", "entropy"], chunk_size):
+        yield DataFrame({"utterance_id": chunk["utterance_id"],
+                         "perplexity": np.exp(chunk["entropy"]),
+                         "entropy": chunk["entropy"]})
 
 def main():
-    entropies = get_entropies("data/Providence/model_inputs/Providence.entropies")
     output_folder = Path("results")
     output_folder.mkdir(exist_ok=True, parents=True)
-    entropies.to_csv("results/Librispeech_360h.csv")
+    with ResultsWriter("results/Librispeech_360h.csv") as writer:
+        for entropies in get_entropies("data/Providence/model_inputs/Providence.manifest.parquet"):
+            writer.write(**{column: entropies[column].to_numpy() for column in entropies.columns})
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,56 +1,324 @@
 """Use the trained model for computing entropies on spoken utterances."""
 from model import EntropyWhisper
 from data_loader import DataLoader
-from typing import List, Optional
+from results_writer import ResultsWriter, read_results, results_path
+from instrumentation import Instrumentation
+from manifest import read_columns
+from typing import List, Optional, Dict, Tuple
+from copy import deepcopy
 import logging
+import json
+import os
 from pathlib import Path
-from math import exp
 from argparse import ArgumentParser
 from pandas import DataFrame
+import pandas as pd
+import torch.multiprocessing as mp
 from tqdm import tqdm
+import numpy as np
 import torch
+from torch import nn
 import yaml
 
 LOGGER = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
+# the keys of the config which change the predictions
+SCORING_KEYS = ["checkpoint", "h5_data", "audio_folder", "utterances", "targets",
+                "layer", "probe", "variable_length", "max_duration", "frontend"]
+
 def compute_entropies(model: EntropyWhisper,
-                      utterances: torch.Tensor
+                      utterances: torch.Tensor,
+                      lengths: Optional[torch.Tensor]=None,
+                      precision: str="fp32"
                       ) ->  List[float]:
     """Computes the entropies of a batch of spoken utterances\
         using the trained model."""
-    with torch.no_grad():
-        entropies = model(utterances)
-    return entropies.tolist()
+    with torch.no_grad(), torch.autocast(device_type=utterances.device.type,
+                                         dtype=torch.bfloat16,
+                                         enabled=precision == "bf16"):
+        entropies = model(utterances, lengths)
+    return entropies.float().tolist()
+
+def quantize(model: EntropyWhisper) -> EntropyWhisper:
+    """Applies dynamic int8 quantization to the linear layers of the encoder (CPU only)."""
+    model.whisper.encoder = torch.quantization.quantize_dynamic(model.whisper.encoder,
+                                                                {nn.Linear},
+                                                                dtype=torch.qint8)
+    return model
+
+def check_accuracy(reference: EntropyWhisper,
+                   model: EntropyWhisper,
+                   data_loader: DataLoader,
+                   device: torch.device,
+                   precision: str,
+                   batch_size: Optional[int]=32,
+                   samples: int=256) -> Dict[str, float]:
+    """
+    Compares the predictions of the reduced precision model with the ones\
+    of the fp32 model on the first `samples` utterances.
+    """
+    LOGGER.info(f"Checking the {precision} predictions against fp32 on {samples} utterances...")
+    ids = data_loader.ids[:samples]
+    expected, computed = [], []
+    for batch in data_loader(batch_size, ids=ids):
+        x = batch.x.to(device)
+        expected.extend(compute_entropies(reference, x, batch.lengths))
+        computed.extend(compute_entropies(model, x, batch.lengths, precision))
+    expected, computed = np.array(expected).ravel(), np.array(computed).ravel()
+    accuracy = {"correlation": float(np.corrcoef(expected, computed)[0, 1]),
+                "mean_absolute_difference": float(np.abs(expected - computed).mean())}
+    LOGGER.info(f"{precision} vs fp32: correlation={accuracy['correlation']},"\
+                f" mean absolute difference={accuracy['mean_absolute_difference']}")
+    return accuracy
+
+def load_model(whisper_checkpoint: str,
+               model_checkpoint: str,
+               device: torch.device,
+               layer: Optional[int]=None,
+               probe: bool=False) -> EntropyWhisper:
+    """
+    Loads the trained model in evaluation mode. The heads of a sweep are saved\
+    without the encoder, which is loaded from the whisper checkpoint.
+    """
+    model = EntropyWhisper(whisper_checkpoint, layer=layer, probe=probe)
+    state_dict = torch.load(model_checkpoint, map_location=device)
+    if "pooling" in state_dict:
+        assert state_dict["pooling"] == model.pooling_name,\
+            f"The head pools the {state_dict['pooling']} hidden states, not the {model.pooling_name} ones."
+        if state_dict["checkpoint"] != whisper_checkpoint:
+            LOGGER.warning(f"The head was trained on {state_dict['checkpoint']}, not {whisper_checkpoint}.")
+        with torch.no_grad():
+            model.w.copy_(state_dict["w"])
+    else:
+        state_dict = {key.replace("module.", ""): value for key, value in state_dict.items()}
+        model.load_state_dict(state_dict)
+    model.eval()
+    model.to(device)
+    return model
 
 def compute_metrics(whisper_checkpoint: str,
                     model_checkpoint: str,
                     data_loader: DataLoader,
-                    batch_size: Optional[int]=32
-                    ) -> DataFrame:
-    """Computes entropies on all data and save them into a DataFrame."""
+                    writer: ResultsWriter,
+                    batch_size: Optional[int]=32,
+                    precision: str="fp32",
+                    check_samples: int=256,
+                    ids: Optional[List[str]]=None,
+                    checkpoint_every: int=50,
+                    layer: Optional[int]=None,
+                    probe: bool=False,
+                    instrumentation: Optional[Instrumentation]=None
+                    ) -> int:
+    """
+    Computes entropies on all data (or on the given `ids`) and writes them\
+    with the results writer, which is flushed every `checkpoint_every` batches.
+    With a reduced `precision` ("int8" or "bf16"), the predictions are first\
+    compared with the fp32 ones on `check_samples` utterances.
+    In probing mode, the entropies predicted by the head of each layer\
+    are written in the `entropy_<layer>` and `perplexity_<layer>` columns.
+    With an instrumentation, the stages of each batch are recorded.
+    Returns the number of scored utterances.
+    """
+    instrumentation = instrumentation or Instrumentation()
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     LOGGER.info(f"Using {device}...")
-    model = EntropyWhisper(whisper_checkpoint)
-    state_dict = torch.load(model_checkpoint, map_location=device)
-    state_dict = {key.replace("module.", ""): value for key, value in state_dict.items()}
-    model.load_state_dict(state_dict)
-    model.eval()
-    model.to(device)
-    results = []
-    bar = tqdm(total=data_loader.sample_size)
-    for batch, gold_entropies, utterances_ids in data_loader(batch_size):
-        batch = batch.to(device)
-        entropies = compute_entropies(model, batch)
-        all_informations = zip(entropies, gold_entropies.tolist(), utterances_ids)
-        for entropy, gold_entropy, utterance_id in all_informations:
-            results.append({
-                "entropy": entropy,
-                "perplexity": exp(entropy),
-                "gold_entropy": gold_entropy,
-                "utterance_id": utterance_id})
-        bar.update(batch.shape[0])
-    return DataFrame(results)
+    model = load_model(whisper_checkpoint, model_checkpoint, device, layer, probe)
+    assert precision in {"fp32", "int8", "bf16"}, f"Unknown precision {precision}"
+    ids = data_loader.ids if ids is None else ids
+    if precision != "fp32":
+        reference = deepcopy(model) if check_samples > 0 and ids else None
+        if precision == "int8":
+            assert device.type == "cpu", "int8 quantization is only available on CPU."
+            model = quantize(model)
+        if reference is not None:
+            check_accuracy(reference, model, data_loader, device, precision, batch_size, check_samples)
+            del reference
+    # the loading of the model and the accuracy check are not counted in the first batch
+    instrumentation.begin("score")
+    bar = tqdm(total=len(ids))
+    batches = instrumentation.iterate(data_loader(batch_size, ids=ids))
+    for step, batch in enumerate(batches, start=1):
+        instrumentation.add_batch(batch)
+        with instrumentation.stage("encoder"):
+            entropies = np.asarray(compute_entropies(model, batch.x.to(device), batch.lengths, precision))
+        if probe:
+            columns = dict()
+            for layer_idx, layer_entropies in enumerate(entropies.T):
+                columns[f"entropy_{layer_idx}"] = layer_entropies
+                columns[f"perplexity_{layer_idx}"] = np.exp(layer_entropies)
+        else:
+            columns = {"entropy": entropies, "perplexity": np.exp(entropies)}
+        with instrumentation.stage("write"):
+            writer.write(**columns,
+                         gold_entropy=batch.y.double().numpy(),
+                         utterance_id=np.asarray(batch.utterance_ids, dtype=object))
+            if step % checkpoint_every == 0:
+                writer.flush()
+        bar.update(batch.x.shape[0])
+        instrumentation.step()
+    writer.flush()
+    instrumentation.epoch()
+    instrumentation.close()
+    return len(ids)
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    """Parses a shard given as 'i/N' (the i-th of N shards, starting at 0)."""
+    index, num_shards = map(int, shard.split("/"))
+    assert 0 <= index < num_shards, f"Invalid shard {shard}"
+    return index, num_shards
+
+def shard_ids(ids: List[str], index: int, num_shards: int) -> List[str]:
+    """
+    Returns the ids of the i-th of N shards. The ids are taken in a round-robin\
+    manner so that the shards get utterances of similar durations.
+    """
+    return ids[index::num_shards]
+
+def shards_folder(output_folder: Path, name: str) -> Path:
+    """Returns the folder where the shards of a results file are checkpointed."""
+    return output_folder / f"{name}.shards"
+
+def shard_path(output_folder: Path,
+               name: str,
+               index: int,
+               num_shards: int,
+               results_format: str="csv") -> Path:
+    """Returns the checkpoint file of a shard."""
+    return results_path(shards_folder(output_folder, name), f"{index}-of-{num_shards}", results_format)
+
+def fingerprint_path(checkpoint_file: Path) -> Path:
+    """Returns the file where the fingerprint of a shard is saved."""
+    return checkpoint_file.with_suffix(".fingerprint.json")
+
+def scoring_fingerprint(config: Dict, model_checkpoint: str, precision: str="fp32") -> Dict:
+    """
+    Returns what the predictions of a scoring run depend on: the trained model\
+    (its path, size and modification time), the precision and the scoring keys\
+    of the config.
+    """
+    stat = os.stat(model_checkpoint)
+    return {"model": str(Path(model_checkpoint).resolve()),
+            "model_size": stat.st_size,
+            "model_mtime_ns": stat.st_mtime_ns,
+            "precision": precision,
+            **{key: config.get(key) for key in SCORING_KEYS}}
+
+def read_fingerprint(checkpoint_file: Path) -> Optional[Dict]:
+    """Returns the fingerprint of a shard, or None if it has none."""
+    if not fingerprint_path(checkpoint_file).exists():
+        return None
+    with open(fingerprint_path(checkpoint_file), "r") as fingerprint_file:
+        return json.load(fingerprint_file)
+
+def build_data_loader(config: Dict) -> DataLoader:
+    """Creates the test data loader from the yaml config."""
+    return DataLoader(h5_file=config["h5_data"],
+                      utterances=config.get("utterances"),
+                      targets=config["targets"],
+                      checkpoint=config["checkpoint"],
+                      variable_length=config.get("variable_length", False),
+                      max_duration=config.get("max_duration"),
+                      max_batch_seconds=config.get("max_batch_seconds"),
+                      bucket_width=config.get("bucket_width", 1.0),
+                      num_workers=config.get("num_workers", 0),
+                      prefetch=config.get("prefetch", 2),
+                      frontend=config.get("frontend", "processor"),
+                      durations=config.get("durations"),
+                      audio_folder=config.get("audio_folder"),
+                      allow_missing_targets=True)
+
+def utterance_ids(config: Dict) -> List[str]:
+    """
+    Returns the ids of the utterances to score, in the order of the results:\
+    those of the utterances file, or all those of the manifest when the audios\
+    are read from the recordings without an utterances file.
+    """
+    if config.get("utterances") is None:
+        assert config.get("audio_folder") is not None, "The utterances file is needed when the audios are not read from the recordings."
+        return read_columns(config["h5_data"], ["utterance_id"])["utterance_id"].tolist()
+    with open(config["utterances"], "r") as sorted_utterances:
+        return [line.strip() for line in sorted_utterances]
+
+def score_shard(config: Dict,
+                model_checkpoint: str,
+                output_folder: Path,
+                index: int,
+                num_shards: int,
+                threads: Optional[int]=None,
+                precision: str="fp32",
+                check_samples: int=256,
+                checkpoint_every: int=50,
+                results_format: str="csv",
+                instrument: bool=False,
+                profile_steps: Optional[str]=None) -> None:
+    """
+    Scores the i-th of N shards of the utterances, checkpointing its results.
+    The utterances already in the checkpoint of the shard are not scored again,\
+    unless it was scored with another model, precision or scoring config.
+    Only the first shard checks the reduced precision predictions.
+    When instrumented, the stages of the batches are recorded next to the checkpoint.
+    """
+    if threads is not None:
+        torch.set_num_threads(threads)
+    data_loader = build_data_loader(config)
+    ids = shard_ids(data_loader.ids, index, num_shards)
+    checkpoint_file = shard_path(output_folder, Path(model_checkpoint).stem, index, num_shards, results_format)
+    fingerprint = scoring_fingerprint(config, model_checkpoint, precision)
+    resume = read_fingerprint(checkpoint_file) == fingerprint
+    if not resume and checkpoint_file.exists():
+        LOGGER.warning(f"{checkpoint_file} was scored with another model, precision or config,"\
+                       " it is scored again from the start.")
+    checkpoint_file.parent.mkdir(exist_ok=True, parents=True)
+    with open(fingerprint_path(checkpoint_file), "w") as fingerprint_file:
+        json.dump(fingerprint, fingerprint_file, indent=2)
+    with ResultsWriter(checkpoint_file, resume=resume) as writer:
+        if writer.rows:
+            scored = set(read_results(checkpoint_file)["utterance_id"])
+            ids = [utterance_id for utterance_id in ids if utterance_id not in scored]
+            LOGGER.info(f"{len(scored)} utterances already scored in {checkpoint_file}.")
+        instrumentation = None
+        if instrument:
+            # the records of the run which is resumed are kept
+            instrumentation = Instrumentation(checkpoint_file.with_suffix(".stages.jsonl"),
+                                              profile_steps,
+                                              resume=writer.rows > 0)
+        LOGGER.info(f"Scoring shard {index}/{num_shards} into {checkpoint_file}...")
+        compute_metrics(whisper_checkpoint=config["checkpoint"],
+                        model_checkpoint=model_checkpoint,
+                        data_loader=data_loader,
+                        writer=writer,
+                        batch_size=config["batch_size"],
+                        precision=precision,
+                        check_samples=check_samples if index == 0 else 0,
+                        ids=ids,
+                        checkpoint_every=checkpoint_every,
+                        layer=config.get("layer"),
+                        probe=config.get("probe", False),
+                        instrumentation=instrumentation)
+
+def merge_shards(output_folder: Path,
+                 name: str,
+                 ids: List[str],
+                 results_format: str="csv",
+                 fingerprint: Optional[Dict]=None) -> DataFrame:
+    """
+    Combines the checkpointed shards of a results file into one DataFrame,\
+    with the utterances in the order of `ids`. When a fingerprint is given,\
+    all the shards must have been scored with it.
+    """
+    shard_files = sorted(shards_folder(output_folder, name).glob(f"*-of-*.{results_format}"))
+    assert shard_files, f"No shards found in {shards_folder(output_folder, name)}"
+    num_shards = {shard_file.stem.split("-of-")[1] for shard_file in shard_files}
+    assert len(num_shards) == 1, f"Shards from different splits found: {shard_files}"
+    if fingerprint is not None:
+        stale = [str(shard_file) for shard_file in shard_files if read_fingerprint(shard_file) != fingerprint]
+        assert not stale, f"Shards scored with another model, precision or config: {stale}, score them again."
+    results = pd.concat([read_results(shard_file) for shard_file in shard_files], ignore_index=True)
+    results = results.drop_duplicates("utterance_id").set_index("utterance_id", drop=False)
+    missing = [utterance_id for utterance_id in ids if utterance_id not in results.index]
+    assert not missing, f"{len(missing)} utterances are not scored yet, e.g. {missing[:5]}"
+    return results.loc[ids].reset_index(drop=True)
 
 def main():
     parser = ArgumentParser()
@@ -62,6 +330,55 @@ def main():
                         "--model",
                         required=True,
                         help="The trained model to use")
+    parser.add_argument("-p",
+                        "--precision",
+                        choices=["fp32", "int8", "bf16"],
+                        default="fp32",
+                        help="int8 quantizes the linear layers of the encoder (CPU only),\
+                            bf16 runs the model in bfloat16 autocast.")
+    parser.add_argument("-s",
+                        "--check_samples",
+                        type=int,
+                        default=256,
+                        help="The number of utterances on which the int8/bf16 predictions\
+                            are compared with the fp32 ones (0 to skip the check).")
+    parser.add_argument("--shard",
+                        default=None,
+                        help="Only score the i-th of N shards, given as 'i/N' (starting at 0).\
+                            The shards are merged afterwards with --merge.")
+    parser.add_argument("-w",
+                        "--workers",
+                        type=int,
+                        default=1,
+                        help="The number of local processes scoring the shards.")
+    parser.add_argument("-t",
+                        "--threads",
+                        type=int,
+                        default=None,
+                        help="The number of torch threads of each worker\
+                            (by default, the CPUs are split between the workers).")
+    parser.add_argument("-e",
+                        "--checkpoint_every",
+                        type=int,
+                        default=50,
+                        help="The number of batches between two checkpoints of a shard.")
+    parser.add_argument("-f",
+                        "--format",
+                        choices=["csv", "parquet"],
+                        default="csv",
+                        help="The format of the results (a parquet results file is a folder of parts).")
+    parser.add_argument("-i",
+                        "--instrument",
+                        action="store_true",
+                        help="Record the time of the stages, the throughput and the peak memory\
+                            of each batch, next to the checkpoint of each shard.")
+    parser.add_argument("--profile_steps",
+                        default=None,
+                        help="A window of batches ('start:stop', starting at 1) traced\
+                            with the torch profiler (needs --instrument).")
+    parser.add_argument("--merge",
+                        action="store_true",
+                        help="Only merge the shards already scored into the results file.")
     
     args = parser.parse_args()
     with open(args.config, "r") as config_file:
@@ -69,17 +386,43 @@ def main():
 
     output_folder = Path("results")
     output_folder.mkdir(exist_ok=True, parents=True)
-    data_loader = DataLoader(h5_file=config["h5_data"],
-                             utterances=config["utterances"],
-                             targets=config["targets"],
-                             checkpoint=config["checkpoint"])
-    
-    results_df = compute_metrics(whisper_checkpoint=config["checkpoint"],
-                                 model_checkpoint=args.model,
-                                 data_loader=data_loader,
-                                 batch_size=config["batch_size"])
     output_filename = Path(args.model).stem
-    results_df.to_csv(output_folder / f"{output_filename}.csv")
+    threads = args.threads
+    if threads is None and args.workers > 1:
+        threads = max(1, (os.cpu_count() or 1) // args.workers)
+    shard_args = (config, args.model, output_folder)
+    shard_kwargs = {"threads": threads,
+                    "precision": args.precision,
+                    "check_samples": args.check_samples,
+                    "checkpoint_every": args.checkpoint_every,
+                    "results_format": args.format,
+                    "instrument": args.instrument,
+                    "profile_steps": args.profile_steps}
+
+    if args.shard is not None:
+        score_shard(*shard_args, *parse_shard(args.shard), **shard_kwargs)
+        return
+    if not args.merge:
+        if args.workers == 1:
+            score_shard(*shard_args, 0, 1, **shard_kwargs)
+        else:
+            # spawned workers do not inherit the torch threads of the parent
+            context = mp.get_context("spawn")
+            workers = [context.Process(target=score_shard,
+                                       args=(*shard_args, index, args.workers),
+                                       kwargs=shard_kwargs)
+                       for index in range(args.workers)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            failed = [index for index, worker in enumerate(workers) if worker.exitcode != 0]
+            assert not failed, f"The shards {failed} failed, run the command again to resume them."
+    ids = utterance_ids(config)
+    results_df = merge_shards(output_folder, output_filename, ids, args.format,
+                              scoring_fingerprint(config, args.model, args.precision))
+    with ResultsWriter(results_path(output_folder, output_filename, args.format)) as writer:
+        writer.write(**{column: results_df[column].to_numpy() for column in results_df.columns})
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
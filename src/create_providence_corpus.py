@@ -1,73 +1,124 @@
 """Module for creating hierarchical data organization of the providence corpus."""
 from pathlib import Path
 from argparse import ArgumentParser
+import os
+import shutil
 import string
+import logging
 import pandas as pd
+from pandas import DataFrame
 from pandas.core.groupby.generic import DataFrameGroupBy
 from tqdm import tqdm
-import pylangacq
+from chat_index import ChatIndex
+from build_state import BuildState, file_hash, rows_hash, run_tasks
+
+LOGGER = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
 
 PUNCTS = "".join(set(string.punctuation) - {"'"})
+COLUMNS = ["transcription", "clean_transcription", "segment_onset", "segment_offset"]
 
-def create_folders(groups: DataFrameGroupBy, output_folder: Path, cha_folder: Path) -> None:
-    """Creates the nested folders from the prepared Providence CSV file."""
-    allowed_speakers = {"Mother", "Target_Child"}
-    for group, data in tqdm(groups):
-        cha_file, speaker = group
-        cha_file = cha_folder / cha_file
-        cha = pylangacq.read_chat(str(cha_file))
-        months = cha.ages(months=True)[0]
-        if speaker not in allowed_speakers:
-            continue
-        months = str(months)
-        child_name = cha_file.parent.stem
-        filename = cha_file.stem
-        raw_age = filename.split("_")[-1]
-        assert len(data["transcription"]) == len(data["clean_transcription"]), "Some mismatches between non-cleaned and cleaned."
+def write_speaker(data: DataFrame, output_folder: Path, cha_file: Path, speaker: str, months: str) -> None:
+    """Writes the utterances of a speaker of a session in the nested folders."""
+    child_name = cha_file.parent.stem
+    filename = cha_file.stem
+    raw_age = filename.split("_")[-1]
+    assert len(data["transcription"]) == len(data["clean_transcription"]), "Some mismatches between non-cleaned and cleaned."
+
+    orthographic_folder = output_folder / "orthographic" / child_name / raw_age
+    orthographic_folder.mkdir(exist_ok=True, parents=True)
+    with open(orthographic_folder / f"{speaker}.orthographic", "w") as orthographic_file:
+        orthographic_file.write("\n".join(data["transcription"]))
 
-        orthographic_folder = output_folder / "orthographic" / child_name / raw_age
-        orthographic_folder.mkdir(exist_ok=True, parents=True)
-        with open(orthographic_folder / f"{speaker}.orthographic", "w") as orthographic_file:
-            orthographic_file.write("\n".join(data["transcription"]))
+    cleaned_folder = output_folder / "cleaned" / child_name / raw_age
+    cleaned_folder.mkdir(exist_ok=True, parents=True)
+    cleaned = [utterance.translate(str.maketrans('', '', PUNCTS)) for utterance in data["clean_transcription"]]
+    with open(cleaned_folder / f"{speaker}.cleaned", "w") as orthographic_file:
+        orthographic_file.write("\n".join(cleaned))
 
-        cleaned_folder = output_folder / "cleaned" / child_name / raw_age
-        cleaned_folder.mkdir(exist_ok=True, parents=True)
-        cleaned = [utterance.translate(str.maketrans('', '', PUNCTS)) for utterance in data["clean_transcription"]]
-        with open(cleaned_folder / f"{speaker}.cleaned", "w") as orthographic_file:
-            orthographic_file.write("\n".join(cleaned))
+    timemarks_folder = output_folder / "timemarks" / child_name / raw_age
+    timemarks_folder.mkdir(exist_ok=True, parents=True)
+    timemarks = zip(data["segment_onset"], data["segment_offset"])
+    timemarks = ["\t".join((str(timemark[0]), str(timemark[1]))) for timemark in timemarks]
+    with open(timemarks_folder / f"{speaker}.timemarks", "w") as orthographic_file:
+        orthographic_file.write("\n".join(timemarks))
 
-        timemarks_folder = output_folder / "timemarks" / child_name / raw_age
-        timemarks_folder.mkdir(exist_ok=True, parents=True)
-        timemarks = zip(data["segment_onset"], data["segment_offset"])
-        timemarks = ["\t".join((str(timemark[0]), str(timemark[1]))) for timemark in timemarks]
-        with open(timemarks_folder / f"{speaker}.timemarks", "w") as orthographic_file:
-            orthographic_file.write("\n".join(timemarks))
+    for age_folder in (orthographic_folder, cleaned_folder, timemarks_folder):
+        with open(age_folder / "months.txt", "w") as months_file:
+            months_file.write(months)
+        with open(age_folder / "filename.txt", "w") as filename_file:
+            filename_file.write(filename)
 
-        with open(orthographic_folder / f"months.txt", "w") as months_orthographic:
-            months_orthographic.write(months) 
-        with open(cleaned_folder / f"months.txt", "w") as months_cleaned:
-            months_cleaned.write(months) 
-        with open(timemarks_folder / f"months.txt", "w") as months_timemarks:
-            months_timemarks.write(months) 
+def _write_speaker(task: tuple) -> str:
+    """Writes the utterances of a speaker, and returns the key of its output."""
+    key, *arguments = task
+    write_speaker(*arguments)
+    return key
 
-        with open(orthographic_folder / f"filename.txt", "w") as filenamne_orthographic:
-            filenamne_orthographic.write(filename) 
-        with open(cleaned_folder / f"filename.txt", "w") as filename_cleaned:
-            filename_cleaned.write(filename) 
-        with open(timemarks_folder / f"filename.txt", "w") as filename_timemarks:
-            filename_timemarks.write(filename) 
+def remove_speaker(key: str, output_folder: Path) -> None:
+    """
+    Deletes the files of a speaker of a session which is not in the corpus\
+    anymore, and the folders of the session once they hold no speaker.
+    """
+    cha_file, speaker = key.rsplit("/", 1)
+    cha_file = Path(cha_file)
+    for folder_type in ("orthographic", "cleaned", "timemarks"):
+        folder = output_folder / folder_type / cha_file.parent.stem / cha_file.stem.split("_")[-1]
+        if not folder.exists():
+            continue
+        (folder / f"{speaker}.{folder_type}").unlink(missing_ok=True)
+        if not any(path.suffix == f".{folder_type}" for path in folder.iterdir()):
+            shutil.rmtree(folder)
+
+def create_folders(groups: DataFrameGroupBy, output_folder: Path, cha_index: ChatIndex, jobs: int=1) -> None:
+    """
+    Creates the nested folders from the prepared Providence CSV file.
+    The speakers of the sessions are written by `jobs` processes, and\
+    are written again only when their rows of the CSV or their cha file changed.
+    The files of the speakers removed from the corpus are deleted.
+    """
+    allowed_speakers = {"Mother", "Target_Child"}
+    state = BuildState(output_folder / "sources.json")
+    cha_hashes = dict()
+    tasks, sources, keys = [], dict(), []
+    for group, data in tqdm(groups):
+        cha_file, speaker = group
+        if speaker not in allowed_speakers:
+            continue
+        key = f"{cha_file}/{speaker}"
+        keys.append(key)
+        cha_file = cha_index.cha_folder / cha_file
+        if cha_file not in cha_hashes:
+            cha_hashes[cha_file] = file_hash(cha_file)
+        sources[key] = {"rows": rows_hash(data[COLUMNS]), "cha": cha_hashes[cha_file]}
+        built = (output_folder / "cleaned" / cha_file.parent.stem / cha_file.stem.split("_")[-1] / f"{speaker}.cleaned").exists()
+        if not built or not state.is_fresh(key, sources[key]):
+            months = str(cha_index.age(cha_file))
+            tasks.append((key, data[COLUMNS], output_folder, cha_file, speaker, months))
+    for key in state.prune(keys):
+        remove_speaker(key, output_folder)
+    LOGGER.info(f"Writing {len(tasks)} speakers of the sessions ({len(keys) - len(tasks)} are up to date)...")
+    for key in tqdm(run_tasks(_write_speaker, tasks, jobs), total=len(tasks)):
+        state.record(key, sources[key])
+        state.save()
+    state.save()
 
 def main():
     parser = ArgumentParser()
     parser.add_argument("-i", "--input_csv", help="CSV file containing all the files.")
     parser.add_argument("-c", "--childes_corpus", help="Folder containing the cha files.")
     parser.add_argument("-o", "--output_folder", help="CSV file containing all the files.")
+    parser.add_argument("-j", "--jobs",
+                        help="The number of processes indexing the ages of the cha files\
+                            and writing the sessions.",
+                        type=int,
+                        default=os.cpu_count())
 
     args = parser.parse_args()
     dataframe = pd.read_csv(args.input_csv, low_memory=False)
     dataframe = dataframe.groupby(["raw_filename", "speaker_role"])
-    create_folders(dataframe, Path(args.output_folder),
-                   Path(args.childes_corpus) / "annotations" / "cha" / "raw")
+    cha_index = ChatIndex(Path(args.childes_corpus) / "annotations" / "cha" / "raw", jobs=args.jobs)
+    create_folders(dataframe, Path(args.output_folder), cha_index, args.jobs)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
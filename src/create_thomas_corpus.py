@@ -1,34 +1,37 @@
 """Module for creating hierarchical data organization of the thomas corpus."""
 from utterances_cleaner_thomas import UtterancesCleaner
+from chat_index import ChatIndex
+from build_state import BuildState, file_hash, run_tasks
 from argparse import ArgumentParser
 from collections import defaultdict
 from pathlib import Path
+import os
+import shutil
+import logging
 import pandas as pd
 import pylangacq
 from tqdm import tqdm
 
-CLEANER = UtterancesCleaner("extra/markers.json")
-
-def get_data(cha_folder: Path) -> dict:
-    """Retrieves all the relevant data from the csv files."""
-    converted_folder = (cha_folder / "converted")
-    csvs = list(converted_folder.glob("*.csv"))
-    for csv in tqdm(csvs):
-        dataframe = pd.read_csv(csv)
-        needed_columns = zip(dataframe["transcription"], dataframe["segment_onset"],
-                             dataframe["segment_offset"], dataframe["speaker_role"])
-        ages = set(dataframe["raw_filename"])
-        assert len(ages) == 1, f"Need to be one file per age. Instead, the csv {csv} has {len(ages)} ages."
-        filename = list(ages)[0]
-        cha_file = cha_folder / "raw" / filename
-        cha = pylangacq.read_chat(str(cha_file))
-        age = cha.ages(months=True)[0]
-        data = {"age" : age, "raw_age": cha_file.stem, "data": defaultdict(list)}
-        for utterance_raw, onset, offset, speaker_role in needed_columns:
-            utterance = pylangacq.chat._clean_utterance(utterance_raw)
-            cleaned = CLEANER.clean(utterance)
-            data["data"][speaker_role].append((utterance_raw, cleaned, onset, offset))
-        yield data
+LOGGER = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+MARKERS = "extra/markers.json"
+CLEANER = UtterancesCleaner(MARKERS)
+
+def get_data(csv: Path, cha_file: Path, age: float) -> dict:
+    """Retrieves all the relevant data from the csv file of a session."""
+    dataframe = pd.read_csv(csv)
+    needed_columns = zip(dataframe["transcription"], dataframe["segment_onset"],
+                         dataframe["segment_offset"], dataframe["speaker_role"])
+    ages = set(dataframe["raw_filename"])
+    assert len(ages) == 1, f"Need to be one file per age. Instead, the csv {csv} has {len(ages)} ages."
+    data = {"age" : age, "raw_age": cha_file.stem, "data": defaultdict(list)}
+    # the sessions are built in parallel, so a session is cleaned in its own process
+    cleaneds = CLEANER.clean_many(pylangacq.chat._clean_utterance(utterance_raw)
+                                  for utterance_raw in dataframe["transcription"])
+    for (utterance_raw, onset, offset, speaker_role), cleaned in zip(needed_columns, cleaneds):
+        data["data"][speaker_role].append((utterance_raw, cleaned, onset, offset))
+    return data
 
 def write_utterances(utterances: str, output_file: Path) -> None:
     """Writes utterances in a given file."""
@@ -36,52 +39,88 @@ def write_utterances(utterances: str, output_file: Path) -> None:
         for utterance in utterances:
             utterance_file.write(f"{utterance}\n")
 
-def make_folder(cha_folder: Path, output_folder: Path):
+def write_session(data: dict, output_folder: Path) -> None:
     """
-    Creates the folders for the different utterances types:\
-    orthographic, cleaned, timemarks.
+    Writes the utterances of a session in the folders of the different\
+    utterances types: orthographic, cleaned, timemarks.
     """
     child_name = "Thomas"
     allowed_speakers = {"Mother", "Target_Child"}
-    for data in get_data(cha_folder):
-        age_orthographic_folder = output_folder / "orthographic" / child_name / data["raw_age"]
-        age_orthographic_folder.mkdir(exist_ok=True, parents=True)
-        age_cleaned_folder = output_folder / "cleaned" / child_name / data["raw_age"]
-        age_cleaned_folder.mkdir(exist_ok=True, parents=True)
-        age_timemarks_folder = output_folder / "timemarks" / child_name / data["raw_age"]
-        age_timemarks_folder.mkdir(exist_ok=True, parents=True)
-
-        for speaker_role in data["data"]:
-            speaker_data = list(zip(*data["data"][speaker_role]))
-            utterances, cleaneds, onsets, offsets = speaker_data
-            timemarks = [f"{onset}\t{offset}" for onset, offset in zip(onsets, offsets)]
-            if speaker_role not in allowed_speakers:
-                continue
-            assert len(utterances) == len(cleaneds) == len(timemarks), "Mismatch in the data"
-
-            utterance_orthographic_output = age_orthographic_folder / f"{speaker_role}.orthographic"
-            utterance_cleaned_output = age_cleaned_folder / f"{speaker_role}.cleaned"
-            utterance_timemarks_output = age_timemarks_folder / f"{speaker_role}.timemarks"
-        
-            write_utterances(utterances, utterance_orthographic_output)
-            write_utterances(cleaneds, utterance_cleaned_output)
-            write_utterances(timemarks, utterance_timemarks_output)
-        
-        with open(age_orthographic_folder / "months.txt", "w") as months_file:
-            months_file.write(str(data["age"]))
-        with open(age_orthographic_folder / "filename.txt", "w") as filename_file:
-            filename_file.write(str(data["raw_age"]))
+    age_orthographic_folder = output_folder / "orthographic" / child_name / data["raw_age"]
+    age_orthographic_folder.mkdir(exist_ok=True, parents=True)
+    age_cleaned_folder = output_folder / "cleaned" / child_name / data["raw_age"]
+    age_cleaned_folder.mkdir(exist_ok=True, parents=True)
+    age_timemarks_folder = output_folder / "timemarks" / child_name / data["raw_age"]
+    age_timemarks_folder.mkdir(exist_ok=True, parents=True)
 
-        with open(age_cleaned_folder / "months.txt", "w") as months_file:
-            months_file.write(str(data["age"]))
-        with open(age_cleaned_folder / "filename.txt", "w") as filename_file:
-            filename_file.write(str(data["raw_age"]))
+    for speaker_role in data["data"]:
+        speaker_data = list(zip(*data["data"][speaker_role]))
+        utterances, cleaneds, onsets, offsets = speaker_data
+        timemarks = [f"{onset}\t{offset}" for onset, offset in zip(onsets, offsets)]
+        if speaker_role not in allowed_speakers:
+            continue
+        assert len(utterances) == len(cleaneds) == len(timemarks), "Mismatch in the data"
+
+        utterance_orthographic_output = age_orthographic_folder / f"{speaker_role}.orthographic"
+        utterance_cleaned_output = age_cleaned_folder / f"{speaker_role}.cleaned"
+        utterance_timemarks_output = age_timemarks_folder / f"{speaker_role}.timemarks"
+
+        write_utterances(utterances, utterance_orthographic_output)
+        write_utterances(cleaneds, utterance_cleaned_output)
+        write_utterances(timemarks, utterance_timemarks_output)
 
-        with open(age_timemarks_folder / "months.txt", "w") as months_file:
+    for age_folder in (age_orthographic_folder, age_cleaned_folder, age_timemarks_folder):
+        with open(age_folder / "months.txt", "w") as months_file:
             months_file.write(str(data["age"]))
-        with open(age_timemarks_folder / "filename.txt", "w") as filename_file:
+        with open(age_folder / "filename.txt", "w") as filename_file:
             filename_file.write(str(data["raw_age"]))
 
+def build_session(csv: Path, cha_file: Path, age: float, output_folder: Path) -> str:
+    """Builds the folders of a session, and returns its name."""
+    write_session(get_data(csv, cha_file, age), output_folder)
+    return cha_file.stem
+
+def _build_session(task: tuple) -> str:
+    return build_session(*task)
+
+def remove_session(session: str, output_folder: Path) -> None:
+    """Deletes the folders of a session which is not in the corpus anymore."""
+    for folder_type in ("orthographic", "cleaned", "timemarks"):
+        shutil.rmtree(output_folder / folder_type / "Thomas" / session, ignore_errors=True)
+
+def session_cha_file(csv: Path, cha_folder: Path) -> Path:
+    """Returns the cha file of a session, given in the first row of its csv file."""
+    filename = pd.read_csv(csv, usecols=["raw_filename"], nrows=1)["raw_filename"][0]
+    return cha_folder / "raw" / filename
+
+def make_folder(cha_folder: Path, output_folder: Path, jobs: int=1):
+    """
+    Creates the folders for the different utterances types:\
+    orthographic, cleaned, timemarks.
+    The sessions are built by `jobs` processes, and a session is built\
+    again only when its csv file, its cha file or the markers changed.
+    The folders of the sessions removed from the corpus are deleted.
+    """
+    cha_index = ChatIndex(cha_folder / "raw", jobs=jobs)
+    state = BuildState(output_folder / "sources.json")
+    markers = file_hash(MARKERS)
+    csvs = sorted((cha_folder / "converted").glob("*.csv"))
+    tasks, sources = [], dict()
+    for csv in csvs:
+        cha_file = session_cha_file(csv, cha_folder)
+        session = cha_file.stem
+        sources[session] = {"csv": file_hash(csv), "cha": file_hash(cha_file), "markers": markers}
+        built = (output_folder / "cleaned" / "Thomas" / session).exists()
+        if not built or not state.is_fresh(session, sources[session]):
+            tasks.append((csv, cha_file, cha_index.age(cha_file), output_folder))
+    for session in state.prune(sources):
+        remove_session(session, output_folder)
+    LOGGER.info(f"Building {len(tasks)} sessions ({len(csvs) - len(tasks)} are up to date)...")
+    for session in tqdm(run_tasks(_build_session, tasks, jobs), total=len(tasks)):
+        state.record(session, sources[session])
+        state.save()
+    state.save()
+
 def main():
     parser = ArgumentParser()
     parser.add_argument("-c", "--childes_corpus",
@@ -90,9 +129,14 @@ def main():
     parser.add_argument("-o", "--output_folder",
                         help="Where the folder will be stored",
                         required=True)
+    parser.add_argument("-j", "--jobs",
+                        help="The number of processes indexing the ages of the cha files\
+                            and building the sessions.",
+                        type=int,
+                        default=os.cpu_count())
 
     args = parser.parse_args()
-    make_folder(Path(args.childes_corpus) / "annotations/cha", Path(args.output_folder))
+    make_folder(Path(args.childes_corpus) / "annotations/cha", Path(args.output_folder), args.jobs)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,14 +1,22 @@
 """This module implements a dataloader for the model."""
-from typing import Union, Iterator, Tuple, List, Optional
+from typing import Union, Iterator, Tuple, List, Optional, NamedTuple, Callable, Dict
 from pathlib import Path
-from itertools import islice, chain
+from itertools import islice
+from collections import defaultdict
+from queue import Empty
 import logging
 import random
+import time
+import traceback
 from random import shuffle
 import torch
+import torch.multiprocessing as mp
 from transformers import AutoProcessor
+from log_mel import LogMelSpectrogram
+from audio_store import open_audio_store
+from durations_index import durations_path, read_durations, sample_hours
+from manifest import read_columns
 import numpy as np
-import h5py
 from tqdm import tqdm
 
 DataPath = Union[str, Path]
@@ -18,12 +26,118 @@ Utterance = Array
 Target = float
 DataItem = Tuple[UtteranceId, Utterance, Target]
 
+# Whisper's encoder is trained on 30 seconds inputs
+MAX_DURATION = 30.0
+# how often (in seconds) the main process checks that a worker is still alive
+WORKER_POLL_SECONDS = 5.0
+
+class Batch(NamedTuple):
+    """A batch of log-mel features, their targets and utterance ids.\
+    `lengths` is the number of non-padding mel frames of each utterance,\
+    it is None when the utterances are padded to 30 seconds.\
+    `stats` holds the audio seconds of the batch and the seconds spent\
+    reading its audios and extracting its features."""
+    x: torch.Tensor
+    y: torch.Tensor
+    utterance_ids: List[UtteranceId]
+    lengths: Optional[torch.Tensor] = None
+    stats: Optional[Dict[str, float]] = None
+
 LOGGER = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
 torch.manual_seed(1797)
 random.seed(1797)
 
+class BucketSampler:
+    """
+    A batch sampler that groups the utterances into duration buckets\
+    and fills each batch up to a maximum number of audio seconds.
+    The cost of a batch is its padded duration: its number of utterances\
+    times the duration of its longest utterance (or `pad_to`).
+    The buckets and the order of the batches are shuffled at each epoch.
+
+    Parameters
+    ----------
+    - duration: Callable
+        Returns the duration (in seconds) of an utterance given its id.
+    - max_batch_seconds: float
+        The maximum number of padded audio seconds in a batch.
+    - bucket_width: float
+        The width (in seconds) of the duration buckets. Default=1.0
+    - pad_to: Optional
+        The duration to which every utterance is padded. Default=None,\
+        meaning the utterances are padded to the longest one in the batch.
+    - seed: int
+        The seed of the shuffling, the epoch is added to it. Default=1797
+    """
+
+    def __init__(self,
+                 duration: Callable[[UtteranceId], float],
+                 max_batch_seconds: float,
+                 bucket_width: float=1.0,
+                 pad_to: Optional[float]=None,
+                 seed: int=1797):
+        self.duration = duration
+        self.max_batch_seconds = max_batch_seconds
+        self.bucket_width = bucket_width
+        self.pad_to = pad_to
+        self.seed = seed
+
+    def __call__(self, ids: List[UtteranceId], epoch: int=0) -> List[List[UtteranceId]]:
+        """Returns the batches of utterance ids for a given epoch."""
+        rng = random.Random(self.seed + epoch)
+        buckets = defaultdict(list)
+        for utterance_id in ids:
+            # padded utterances all cost the same, so they share a single bucket
+            bucket = 0 if self.pad_to else int(self.duration(utterance_id) // self.bucket_width)
+            buckets[bucket].append(utterance_id)
+        batches = []
+        for bucket in buckets.values():
+            rng.shuffle(bucket)
+            batch, longest = [], 0.0
+            for utterance_id in bucket:
+                duration = self.pad_to or max(longest, self.duration(utterance_id))
+                if batch and (len(batch) + 1) * duration > self.max_batch_seconds:
+                    batches.append(batch)
+                    batch, duration = [], self.pad_to or self.duration(utterance_id)
+                batch.append(utterance_id)
+                longest = duration
+            if batch:
+                batches.append(batch)
+        rng.shuffle(batches)
+        return batches
+
+def _prefetch_worker(data_loader: "DataLoader",
+                     batches: List[List[UtteranceId]],
+                     output_queue: mp.Queue,
+                     done: mp.Event) -> None:
+    """Loads the given batches with its own audio store handle and pushes them into the queue."""
+    torch.set_num_threads(1)
+    try:
+        data_loader.open()
+        for utterance_ids in batches:
+            output_queue.put(data_loader.load_batch(utterance_ids))
+    except Exception:
+        # the exception itself may not be picklable, its traceback always is
+        output_queue.put(RuntimeError(f"A dataloader worker failed:\n{traceback.format_exc()}"))
+    # the tensors are shared with the main process, so the worker\
+    # has to stay alive until they are received
+    done.wait()
+
+def receive(queue: mp.Queue, worker: mp.Process) -> Union[Batch, Exception]:
+    """
+    Waits for the next batch of a worker. A worker which died before\
+    sending it (e.g. killed by the OOM killer) raises a RuntimeError\
+    instead of blocking the main process forever.
+    """
+    while True:
+        try:
+            return queue.get(timeout=WORKER_POLL_SECONDS)
+        except Empty:
+            if not worker.is_alive():
+                raise RuntimeError(f"A dataloader worker exited unexpectedly (exit code {worker.exitcode}).")
+
 class DataLoader:
     """
     A dataloder for the entropies predictor model.
@@ -31,11 +145,15 @@ class DataLoader:
     Parameters
     ----------
     - h5_file:
-        Path to the h5py file (numpy arrays of the audios).
+        Path to the h5py file (numpy arrays of the audios), or to\
+        the memory-mapped audio file (with '.audio' as extension),\
+        or to the manifest of the corpus when `audio_folder` is given.
     - utterances: str, Path
-        Path to the file storing the utterances keys.
+        Path to the file storing the utterances keys. It can be None when\
+        `audio_folder` is given, all the utterances of the manifest are then used.
     - targets: str, Path.
-        Path to the file containing targets (entropies) for each utterance.
+        Path to the manifest of the corpus, or to the legacy file containing\
+        targets (entropies) for each utterance.
     - checkpoint: str
         The path to the huggingface checkpoint of the processor.
     - sampling_rate: int
@@ -43,37 +161,150 @@ class DataLoader:
     - sub_hours: Optional
         The number of sub hours to consider. Default=None, meaning\
         all the utterances are considered.
+    - variable_length: bool
+        Whether to trim the log-mel features to the longest utterance of\
+        each batch instead of padding them to 30 seconds. Default=False
+    - max_duration: Optional
+        In variable length mode, the duration (in seconds) at which the\
+        utterances are truncated. Default=None, meaning 30 seconds.
+    - max_batch_seconds: Optional
+        If given, the batches are built by a `BucketSampler` filling them\
+        up to this number of padded audio seconds, and `batch_size` is ignored.\
+        Default=None, meaning fixed size batches in the order of `utterances`.
+    - bucket_width: float
+        The width (in seconds) of the duration buckets. Default=1.0
+    - seed: int
+        The seed used to shuffle the buckets. Default=1797
+    - num_workers: int
+        The number of worker processes reading and featurizing the batches\
+        in the background. Default=0, meaning the batches are loaded\
+        in the main process.
+    - prefetch: int
+        The number of batches each worker can prepare in advance. Default=2
+    - frontend: str
+        How the log-mel features are computed: "processor" uses the huggingface\
+        processor, "torch" uses the batched `LogMelSpectrogram`. Default="processor"
+    - durations: Optional
+        Path to the durations index written at ingestion. Default=None, meaning\
+        the `.durations` file next to `utterances` if it exists (otherwise,\
+        the durations are read from the audio store).
+    - stratify: Optional
+        The column of the durations index ("family", "speaker" or "age") by\
+        which the `sub_hours` subset is stratified. Default=None
+    - audio_folder: Optional
+        The folder of the raw recordings, from which the utterances are read\
+        directly, without copying them into a h5py file. Default=None
+    - allow_missing_targets: bool
+        Whether the utterances without target are kept, with NaN as target\
+        (when only scoring). Default=False, meaning they are dropped.
     """
 
     def __init__(self,
                  h5_file: DataPath,
-                 utterances: DataPath,
+                 utterances: Optional[DataPath],
                  targets: DataPath,
                  checkpoint: str,
                  sampling_rate: int=16000,
-                 sub_hours:Optional[int]=None):
+                 sub_hours:Optional[int]=None,
+                 variable_length: bool=False,
+                 max_duration: Optional[float]=None,
+                 max_batch_seconds: Optional[float]=None,
+                 bucket_width: float=1.0,
+                 seed: int=1797,
+                 num_workers: int=0,
+                 prefetch: int=2,
+                 frontend: str="processor",
+                 durations: Optional[DataPath]=None,
+                 stratify: Optional[str]=None,
+                 audio_folder: Optional[DataPath]=None,
+                 allow_missing_targets: bool=False):
         self.targets_path = targets
+        self.allow_missing_targets = allow_missing_targets
         self.load_targets()
-        self.h5_file = h5py.File(h5_file)
+        self.h5_path = h5_file
+        self.audio_folder = audio_folder
+        self.open()
+        self.num_workers = num_workers
+        self.prefetch = prefetch
         self.sampling_rate = sampling_rate
-        with open(utterances, "r") as sorted_utterances:
-            self.ids = [line.strip() for line in sorted_utterances]
+        self.variable_length = variable_length
+        self.max_duration = min(max_duration or MAX_DURATION, MAX_DURATION)
+        self.durations = dict()
+        if utterances is None:
+            assert audio_folder is not None, "The utterances file is needed when the audios are not read from the recordings."
+            self.ids = list(self.audio.ids)
+        else:
+            with open(utterances, "r") as sorted_utterances:
+                self.ids = [line.strip() for line in sorted_utterances]
+        if not allow_missing_targets:
+            self.drop_missing_targets()
+        if durations is None and utterances is not None:
+            durations = durations_path(utterances)
+        self.index = read_durations(durations) if durations is not None and Path(durations).exists() else None
+        if self.index is not None:
+            self.durations = dict(zip(self.index.index, self.index["duration"]))
         if sub_hours is not None:
-            self.subset(sub_hours)
+            self.subset(sub_hours, stratify)
         self.sample_size = len(self.ids)
         self.processor = AutoProcessor.from_pretrained(checkpoint)
+        self.hop_length = self.processor.feature_extractor.hop_length
+        assert frontend in {"processor", "torch"}, f"Unknown frontend {frontend}"
+        self.log_mel = None
+        if frontend == "torch":
+            self.log_mel = LogMelSpectrogram.from_feature_extractor(self.processor.feature_extractor)
+        self.sampler = None
+        if max_batch_seconds is not None:
+            self.sampler = BucketSampler(duration=self.duration,
+                                         max_batch_seconds=max_batch_seconds,
+                                         bucket_width=bucket_width,
+                                         pad_to=None if variable_length else MAX_DURATION,
+                                         seed=seed)
         self.has_timemarks = None
+
+    def duration(self, utterance_id: UtteranceId) -> float:
+        """Returns the duration (in seconds) of a given utterance, as seen by the encoder."""
+        if utterance_id not in self.durations:
+            self.durations[utterance_id] = self.audio.num_samples(utterance_id) / self.sampling_rate
+        return min(self.durations[utterance_id], self.max_duration)
+
+    def open(self) -> None:
+        """Opens the audio store. Each process has to open its own handle."""
+        self.audio = open_audio_store(self.h5_path, self.audio_folder)
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        # h5py handles cannot be shared between processes
+        state["audio"] = None
+        return state
+
+    @property
+    def features_name(self) -> str:
+        """A name identifying how the inputs of the encoder are built."""
+        if not self.variable_length:
+            return "padded"
+        return f"trimmed-{self.max_duration:g}s"
     
-    def subset(self, sub_hours: int):
-        """Subsetting the whole corpus for a given number of hours."""
+    def subset(self, sub_hours: int, stratify: Optional[str]=None):
+        """
+        Subsetting the whole corpus for a given number of hours.
+        With the durations index, the subset is sampled at once, optionally\
+        stratified by one of its columns. Otherwise, the durations are read\
+        from the audio store until the number of hours is reached.
+        """
         LOGGER.info(f"Getting a subset of {sub_hours} hours...")
+        if self.index is not None:
+            shuffle(self.ids)
+            self.ids = sample_hours(self.index, self.ids, sub_hours, stratify)
+            return
+        assert stratify is None, "Stratified subsets need the durations index."
         finish_message = "Data subsetting finished! Exactly {} hours (for {} utterances) were sampled."
         new_ids = []
         total_hours = 0.0
         pbar = tqdm(total=sub_hours)
         shuffle(self.ids)
         for audio_id in self.ids:
-            frames = self.h5_file[audio_id].shape[0]
+            frames = self.audio.num_samples(audio_id)
+            self.durations[audio_id] = frames / self.sampling_rate
             hour = (frames / self.sampling_rate) / 3600
             pbar.update(hour)
             total_hours += hour
@@ -87,34 +318,116 @@ class DataLoader:
 
     def load_targets(self):
         """Reads and stores the targets."""
-        self.utterance_targets = dict()
-        with open(self.targets_path, "r") as utterances_targets:
-            for target in utterances_targets:
-                target.strip()
-                utterance_id, entropy = target.split("\t")
-                self.utterance_targets[utterance_id] = float(entropy)
-
-    def utterances_iterator(self):
+        targets = read_columns(self.targets_path, ["utterance_id", "entropy"]).dropna()
+        self.utterance_targets = dict(zip(targets["utterance_id"], targets["entropy"]))
+
+    def drop_missing_targets(self) -> None:
+        """Drops the utterances without target, which cannot be trained on."""
+        ids = [utterance_id for utterance_id in self.ids if utterance_id in self.utterance_targets]
+        if len(ids) < len(self.ids):
+            LOGGER.warning(f"{len(self.ids) - len(ids)} utterances without target are dropped.")
+        self.ids = ids
+
+    def targets(self, utterance_ids: List[UtteranceId]) -> torch.Tensor:
+        """
+        Returns the targets of the given utterances\
+        (NaN for those without target, if they are allowed).
+        """
+        if self.allow_missing_targets:
+            return torch.tensor([self.utterance_targets.get(utterance_id, float("nan"))
+                                 for utterance_id in utterance_ids])
+        return torch.tensor([self.utterance_targets[utterance_id] for utterance_id in utterance_ids])
+
+    def id_batches(self,
+                   batch_size: int=32,
+                   ids: Optional[List[UtteranceId]]=None,
+                   epoch: int=0
+                   ) -> Iterator[List[UtteranceId]]:
+        """An iterator over batches of utterance ids."""
+        ids = self.ids if ids is None else ids
+        if self.sampler is not None:
+            yield from self.sampler(ids, epoch)
+            return
+        iterator = iter(ids)
+        for first in iterator:
+            yield [first, *islice(iterator, batch_size - 1)]
+
+    def utterances_iterator(self, ids: Optional[List[UtteranceId]]=None):
         """An iterator over audio frames."""
-        for utterance_id in self.ids:
-            yield utterance_id, self.h5_file[utterance_id][:]
+        for utterance_id in (self.ids if ids is None else ids):
+            yield utterance_id, self.audio[utterance_id]
 
-    def data_iterator(self) -> Iterator[DataItem]:
+    def data_iterator(self, ids: Optional[List[UtteranceId]]=None) -> Iterator[DataItem]:
         """An iterator over utterances and their corresponding labels."""
-        for utterance_id, utterance in self.utterances_iterator():
+        for utterance_id, utterance in self.utterances_iterator(ids):
             entropy = self.utterance_targets[utterance_id]
             yield utterance_id, utterance, entropy
 
+    def load_batch(self, utterance_ids: List[UtteranceId]) -> Batch:
+        """Reads the given utterances and extracts their log-mel features."""
+        start = time.perf_counter()
+        utterances = self.audio.read(utterance_ids)
+        read = time.perf_counter()
+        stats = {"audio_seconds": sum(len(utterance) for utterance in utterances) / self.sampling_rate,
+                 "read": read - start}
+        y = self.targets(utterance_ids)
+        lengths = None
+        if self.variable_length:
+            max_samples = int(self.max_duration * self.sampling_rate)
+            utterances = [utterance[:max_samples] for utterance in utterances]
+            lengths = torch.tensor([len(utterance) // self.hop_length for utterance in utterances])
+        if self.log_mel is not None:
+            with torch.no_grad():
+                x = self.log_mel(self.log_mel.pad(utterances, longest=self.variable_length))
+            stats["features"] = time.perf_counter() - read
+            return Batch(x, y, list(utterance_ids), lengths, stats)
+        inputs = self.processor(utterances,
+                                sampling_rate=self.sampling_rate,
+                                padding="longest" if self.variable_length else "max_length",
+                                return_tensors="pt")
+        stats["features"] = time.perf_counter() - read
+        return Batch(inputs["input_features"], y, list(utterance_ids), lengths, stats)
+
     def __call__(self,
-                 batch_size: int=32
-                 ) -> Iterator[Tuple[Array, Array, List[UtteranceId]]]:
-        """Creates an iterator over batches."""
-        iterator = self.data_iterator()
-        for first in iterator:
-            utterance_ids, utterances, entropies = zip(*chain([first], islice(iterator, batch_size - 1)))
-            inputs = self.processor(utterances,
-                                    sampling_rate=self.sampling_rate,
-                                    return_tensors="pt")
-            y = torch.tensor(entropies)
-            x = inputs["input_features"]
-            yield x, y, list(utterance_ids)
\ No newline at end of file
+                 batch_size: int=32,
+                 ids: Optional[List[UtteranceId]]=None,
+                 epoch: int=0
+                 ) -> Iterator[Batch]:
+        """
+        Creates an iterator over batches. If `ids` is given,\
+        only these utterances are iterated.
+        """
+        if self.num_workers > 0:
+            yield from self.prefetched(list(self.id_batches(batch_size, ids, epoch)))
+            return
+        for utterance_ids in self.id_batches(batch_size, ids, epoch):
+            yield self.load_batch(utterance_ids)
+
+    def prefetched(self, batches: List[List[UtteranceId]]) -> Iterator[Batch]:
+        """
+        Loads the batches in worker processes. The i-th batch is loaded by the\
+        (i % num_workers)-th worker, which has its own bounded queue, so the\
+        batches come out in the same order as `batches`.
+        """
+        context = mp.get_context()
+        queues = [context.Queue(maxsize=self.prefetch) for _ in range(self.num_workers)]
+        done = context.Event()
+        workers = [context.Process(target=_prefetch_worker,
+                                   args=(self, batches[worker::self.num_workers], queue, done),
+                                   daemon=True)
+                   for worker, queue in enumerate(queues)]
+        for worker in workers:
+            worker.start()
+        try:
+            for idx in range(len(batches)):
+                batch = receive(queues[idx % self.num_workers], workers[idx % self.num_workers])
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            done.set()
+            for worker in workers:
+                worker.join(timeout=1)
+                if worker.is_alive():
+                    worker.terminate()
+                    worker.join()
\ No newline at end of file
@@ -0,0 +1,71 @@
+"""This module implements the index of the durations (and speakers) of the utterances."""
+from typing import Union, Dict, Tuple, List, Optional
+from pathlib import Path
+import csv
+import logging
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+DataPath = Union[str, Path]
+UtteranceId = str
+Informations = Tuple[str, str, str] # the family, the speaker and the age of an utterance
+
+LOGGER = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+COLUMNS = ["utterance_id", "duration", "family", "speaker", "age"]
+
+def durations_path(utterances_path: DataPath) -> Path:
+    """Returns the path of the durations index written next to the `.sorted` file."""
+    return Path(utterances_path).with_suffix(".durations")
+
+def write_durations(path: DataPath,
+                    durations: List[Tuple[UtteranceId, float]],
+                    informations: Dict[UtteranceId, Informations]) -> None:
+    """
+    Writes the index: one line per utterance with its id, its duration\
+    (in seconds), and its family, speaker and age when they are known.
+    """
+    with open(path, "w") as durations_file:
+        for utterance_id, duration in durations:
+            family, speaker, age = informations.get(utterance_id, ("", "", ""))
+            durations_file.write(f"{utterance_id}\t{duration!r}\t{family}\t{speaker}\t{age}\n")
+
+def read_durations(path: DataPath) -> DataFrame:
+    """Reads the index into a DataFrame indexed by the utterance ids."""
+    return pd.read_csv(path,
+                       sep="\t",
+                       header=None,
+                       names=COLUMNS,
+                       dtype={"utterance_id": str, "duration": float, "family": str, "speaker": str},
+                       quoting=csv.QUOTE_NONE,
+                       float_precision="round_trip").set_index("utterance_id")
+
+def sample_hours(index: DataFrame,
+                 ids: List[UtteranceId],
+                 sub_hours: float,
+                 stratify: Optional[str]=None) -> List[UtteranceId]:
+    """
+    Takes the utterances in the order of `ids` (shuffled beforehand) until\
+    their durations sum to `sub_hours`. With `stratify` (a column of the index),\
+    each group gets a share of the hours proportional to its share of the corpus,\
+    so that the subset keeps the balance of the corpus.
+    The subset is returned sorted by duration.
+    """
+    utterances = index.loc[ids, ["duration"]]
+    hours = utterances["duration"].to_numpy() / 3600
+    if stratify is None:
+        groups = np.zeros(len(utterances), dtype=np.int64)
+    else:
+        assert stratify in COLUMNS[2:], f"Cannot stratify by {stratify}"
+        groups = pd.factorize(index.loc[ids, stratify].fillna(""))[0]
+    group_hours = np.bincount(groups, weights=hours)
+    targets = group_hours * min(1.0, sub_hours / group_hours.sum())
+    # the hours taken before each utterance, in its group
+    taken = pd.Series(hours).groupby(groups).cumsum().to_numpy() - hours
+    selected = utterances[taken < targets[groups] - 1e-12]
+    LOGGER.info(f"Exactly {selected['duration'].sum() / 3600} hours"\
+                f" (for {len(selected)} utterances) were sampled.")
+    selected = selected.reset_index().sort_values(["duration", "utterance_id"])
+    return selected["utterance_id"].tolist()
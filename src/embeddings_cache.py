@@ -0,0 +1,142 @@
+"""This module implements an on-disk cache of the pooled Whisper encoder features."""
+from typing import Union, List, Iterable, Tuple, Optional
+from pathlib import Path
+import hashlib
+import os
+import logging
+import numpy as np
+import torch
+import h5py
+
+CachePath = Union[str, Path]
+UtteranceId = str
+
+LOGGER = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+def sources_key(sources: Iterable[CachePath]) -> str:
+    """
+    Returns a short key of the files from which the audios are read:\
+    their paths, sizes and modification times. A corpus ingested again\
+    gets another key, so its features are not read from a stale cache.
+    """
+    digest = hashlib.sha1()
+    for source in sources:
+        stat = os.stat(source)
+        digest.update(f"{os.path.abspath(source)}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()[:12]
+
+def cache_name(checkpoint: str,
+               features_name: str="padded",
+               pooling_name: str="last-layer",
+               source: Optional[str]=None) -> str:
+    """Returns the name under which the features of a whisper checkpoint are cached."""
+    name = checkpoint.strip("/").replace("/", "_")
+    if features_name != "padded":
+        name = f"{name}_{features_name}"
+    if pooling_name != "last-layer":
+        name = f"{name}_{pooling_name}"
+    if source is not None:
+        name = f"{name}_{source}"
+    return name
+
+class EmbeddingsCache:
+    """
+    An on-disk store of the pooled encoder features of the utterances.
+    Since the whisper encoder is frozen, its pooled representations\
+    only depend on the utterance and the checkpoint: they are computed once\
+    and reused across epochs and trainings. The features of the audios\
+    of another ingestion are stored in another file (see `sources_key`).
+
+    The features of a checkpoint are stored in one h5py file holding\
+    an `ids` dataset and a `features` dataset of shape [n_utterances, d_model]\
+    (or [n_utterances, num_hidden_states, d_model] when all the layers are pooled).
+    Features pooled from trimmed inputs, or from other layers, are stored in their own file.
+
+    Parameters
+    ----------
+    - cache_folder: str, Path
+        The folder where the cached features are stored.
+    - checkpoint: str
+        The huggingface checkpoint of the whisper encoder.
+    - features_name: str
+        How the encoder inputs are built (see `DataLoader.features_name`).\
+        Default="padded"
+    - pooling_name: str
+        Which encoder layers are pooled (see `EntropyWhisper.pooling_name`).\
+        Default="last-layer"
+    - source: Optional
+        The key of the files of the audios (see `sources_key`). Default=None
+    """
+
+    def __init__(self,
+                 cache_folder: CachePath,
+                 checkpoint: str,
+                 features_name: str="padded",
+                 pooling_name: str="last-layer",
+                 source: Optional[str]=None):
+        cache_folder = Path(cache_folder)
+        cache_folder.mkdir(exist_ok=True, parents=True)
+        self.path = cache_folder / f"{cache_name(checkpoint, features_name, pooling_name, source)}.hdf5"
+        self.h5_file = h5py.File(self.path, "a")
+        if "ids" in self.h5_file:
+            ids = self.h5_file["ids"].asstr()[:]
+        else:
+            ids = []
+        self.index = {utterance_id: row for row, utterance_id in enumerate(ids)}
+        LOGGER.info(f"{len(self.index)} cached utterances found in {self.path}.")
+
+    def __contains__(self, utterance_id: UtteranceId) -> bool:
+        return utterance_id in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def missing(self, utterance_ids: Iterable[UtteranceId]) -> List[UtteranceId]:
+        """Returns the utterances that are not yet cached."""
+        return [utterance_id for utterance_id in utterance_ids if utterance_id not in self.index]
+
+    def _create_datasets(self, shape: Tuple[int, ...]):
+        """Creates the resizable datasets storing the ids and the features of a given shape."""
+        self.h5_file.create_dataset("ids",
+                                    shape=(0,),
+                                    maxshape=(None,),
+                                    dtype=h5py.string_dtype())
+        self.h5_file.create_dataset("features",
+                                    shape=(0, *shape),
+                                    maxshape=(None, *shape),
+                                    chunks=(256, *shape),
+                                    dtype="float32")
+
+    def put(self, utterance_ids: List[UtteranceId], pooled: torch.Tensor) -> None:
+        """Stores the pooled features of the given utterances."""
+        new = [(utterance_id, row) for row, utterance_id in enumerate(utterance_ids)
+               if utterance_id not in self.index]
+        if not new:
+            return
+        new_ids, rows = zip(*new)
+        features = pooled.detach().cpu().float().numpy()[list(rows)]
+        if "features" not in self.h5_file:
+            self._create_datasets(features.shape[1:])
+        start = len(self.index)
+        end = start + len(new_ids)
+        self.h5_file["ids"].resize((end,))
+        self.h5_file["features"].resize(end, axis=0)
+        self.h5_file["ids"][start:end] = new_ids
+        self.h5_file["features"][start:end] = features
+        self.h5_file.flush()
+        for row, utterance_id in enumerate(new_ids, start=start):
+            self.index[utterance_id] = row
+
+    def get(self, utterance_ids: List[UtteranceId]) -> torch.Tensor:
+        """Returns the cached features of the given utterances."""
+        rows = np.array([self.index[utterance_id] for utterance_id in utterance_ids])
+        # h5py only reads rows given in increasing order
+        order = np.argsort(rows)
+        features = np.empty((len(rows), *self.h5_file["features"].shape[1:]), dtype="float32")
+        features[order] = self.h5_file["features"][rows[order]]
+        return torch.from_numpy(features)
+
+    def close(self) -> None:
+        """Closes the underlying h5py file."""
+        self.h5_file.close()
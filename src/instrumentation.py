@@ -0,0 +1,228 @@
+"""This module implements an opt-in instrumentation of the training and scoring loops."""
+from typing import Union, Dict, Iterable, Iterator, Optional, Tuple, TypeVar
+from contextlib import contextmanager, nullcontext
+from collections import defaultdict
+from pathlib import Path
+import json
+import resource
+import sys
+import time
+import logging
+import torch
+
+LogPath = Union[str, Path]
+Item = TypeVar("Item")
+
+LOGGER = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+def parse_window(window: Optional[str]) -> Optional[Tuple[int, int]]:
+    """Parses a window of steps given as 'start:stop' (the steps start at 1, stop is excluded)."""
+    if window is None:
+        return None
+    start, stop = map(int, window.split(":"))
+    assert 1 <= start < stop, f"Invalid window of steps {window}"
+    return start, stop
+
+def peak_rss_mb() -> float:
+    """Returns the peak resident set size of the process, in megabytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # in kilobytes on linux, in bytes on macos
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+class Instrumentation:
+    """
+    Records the wall time of the stages of each step (a batch), and writes\
+    a json line per step and per epoch, with the seconds of each stage,\
+    the utterances and audio seconds processed per second, and the peak memory.
+    When `path` is None, nothing is recorded and the stages are not timed.
+
+    The stages are timed with `stage`, the waits for the batches with `iterate`,\
+    and the stages timed by the dataloader (reading the audios and extracting\
+    the features, possibly in its workers) are added with `add_batch`.
+    The records are labeled with the current phase of the run (e.g. filling\
+    the cache, then training), started with `begin`.
+
+    Parameters
+    ----------
+    - path: str, Path
+        The json lines file. Default=None, meaning no instrumentation.
+    - profile_steps: Optional
+        A window of steps ('start:stop') traced by `torch.profiler`. Default=None
+    - trace_path: str, Path
+        Where the chrome trace of the profiled steps is written.\
+        Default: next to the json lines file.
+    - resume: bool
+        Whether the records are appended to the json lines file\
+        of a run which is resumed. Default=False
+    """
+
+    def __init__(self,
+                 path: Optional[LogPath]=None,
+                 profile_steps: Optional[str]=None,
+                 trace_path: Optional[LogPath]=None,
+                 resume: bool=False):
+        self.enabled = path is not None
+        self.path = Path(path) if self.enabled else None
+        self.synchronize = torch.cuda.is_available()
+        self.step_count = 0
+        self.epoch_count = 0
+        self.phase: Optional[str] = None
+        self.reset_step()
+        self.reset_epoch()
+        self.profiler = None
+        self.window = parse_window(profile_steps)
+        if self.enabled:
+            self.path.parent.mkdir(exist_ok=True, parents=True)
+            self.log_file = open(self.path, "a" if resume else "w")
+        if self.enabled and self.window is not None:
+            start, stop = self.window
+            self.trace_path = Path(trace_path or self.path.with_suffix(".trace.json"))
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(skip_first=start - 1, wait=0, warmup=0,
+                                                 active=stop - start, repeat=1),
+                on_trace_ready=self.export_trace,
+                record_shapes=True,
+                profile_memory=True)
+            self.profiler.start()
+
+    def export_trace(self, profiler: "torch.profiler.profile") -> None:
+        """Writes the chrome trace of the profiled steps."""
+        profiler.export_chrome_trace(str(self.trace_path))
+        LOGGER.info(f"The trace of the profiled steps is written in {self.trace_path}.")
+
+    def begin(self, phase: str) -> None:
+        """Starts a phase of the run: its epochs are counted from 1 and its first step from now."""
+        self.phase = phase
+        self.epoch_count = 0
+        self.reset_epoch()
+        self.reset_step()
+
+    def reset_step(self) -> None:
+        self.seconds: Dict[str, float] = defaultdict(float)
+        self.utterances = 0
+        self.audio_seconds = 0.0
+        self.step_start = time.perf_counter()
+
+    def reset_epoch(self) -> None:
+        self.epoch_seconds: Dict[str, float] = defaultdict(float)
+        self.epoch_utterances = 0
+        self.epoch_audio_seconds = 0.0
+        self.epoch_steps = 0
+        self.epoch_start = time.perf_counter()
+
+    @contextmanager
+    def _stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.synchronize:
+                # the cuda kernels are asynchronous
+                torch.cuda.synchronize()
+            self.seconds[name] += time.perf_counter() - start
+
+    def stage(self, name: str):
+        """A context manager timing a stage of the current step."""
+        return self._stage(name) if self.enabled else nullcontext()
+
+    def iterate(self, iterable: Iterable[Item], name: str="data") -> Iterator[Item]:
+        """Iterates over the batches, timing the wait for each one as a stage."""
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def add_batch(self, batch) -> None:
+        """Adds the utterances, the audio seconds and the stages timed by the dataloader."""
+        if not self.enabled:
+            return
+        self.add(len(batch.utterance_ids), **(batch.stats or dict()))
+
+    def add(self, utterances: int, audio_seconds: float=0.0, **seconds: float) -> None:
+        """Adds the utterances and the audio seconds of the current step, and timed stages."""
+        if not self.enabled:
+            return
+        self.utterances += utterances
+        self.audio_seconds += audio_seconds
+        for name, stage_seconds in seconds.items():
+            self.seconds[name] += stage_seconds
+
+    def write(self, record: Dict[str, object]) -> None:
+        self.log_file.write(json.dumps(record) + "\n")
+        self.log_file.flush()
+
+    def throughputs(self, utterances: int, audio_seconds: float, seconds: float) -> Dict[str, float]:
+        memory = {"peak_rss_mb": peak_rss_mb()}
+        if torch.cuda.is_available():
+            memory["peak_cuda_mb"] = torch.cuda.max_memory_allocated() / (1 << 20)
+        return {"utterances": utterances,
+                "audio_seconds": audio_seconds,
+                "wall_seconds": seconds,
+                "utterances_per_second": utterances / seconds if seconds else 0.0,
+                "audio_seconds_per_second": audio_seconds / seconds if seconds else 0.0,
+                **memory}
+
+    def step(self) -> None:
+        """Ends the current step: writes its record and advances the profiler."""
+        if not self.enabled:
+            return
+        self.step_count += 1
+        self.epoch_steps += 1
+        wall_seconds = time.perf_counter() - self.step_start
+        self.write({"type": "step",
+                    "phase": self.phase,
+                    "epoch": self.epoch_count + 1,
+                    "step": self.step_count,
+                    "seconds": dict(self.seconds),
+                    **self.throughputs(self.utterances, self.audio_seconds, wall_seconds)})
+        for name, stage_seconds in self.seconds.items():
+            self.epoch_seconds[name] += stage_seconds
+        self.epoch_utterances += self.utterances
+        self.epoch_audio_seconds += self.audio_seconds
+        if self.profiler is not None:
+            self.profiler.step()
+        self.reset_step()
+
+    def epoch(self, **values: object) -> None:
+        """
+        Ends the current epoch and writes its record, with the given values (e.g. the loss).
+        The stages timed since the last step (e.g. a final solve) count for the epoch.
+        """
+        if not self.enabled:
+            return
+        for name, stage_seconds in self.seconds.items():
+            self.epoch_seconds[name] += stage_seconds
+        self.epoch_count += 1
+        wall_seconds = time.perf_counter() - self.epoch_start
+        self.write({"type": "epoch",
+                    "phase": self.phase,
+                    "epoch": self.epoch_count,
+                    "steps": self.epoch_steps,
+                    "seconds": dict(self.epoch_seconds),
+                    **self.throughputs(self.epoch_utterances, self.epoch_audio_seconds, wall_seconds),
+                    **values})
+        self.reset_epoch()
+        self.reset_step()
+
+    def close(self) -> None:
+        """Stops the profiler and closes the json lines file."""
+        if self.profiler is not None:
+            start, stop = self.window
+            if self.step_count < stop - 1:
+                LOGGER.warning(f"Only {self.step_count} steps were run, so the profiled steps {start}:{stop}"\
+                               " were not all traced: the trace is missing or partial.")
+            self.profiler.stop()
+            self.profiler = None
+        if self.enabled and not self.log_file.closed:
+            self.log_file.close()
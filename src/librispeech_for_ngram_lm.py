@@ -1,43 +1,66 @@
 """Module for preparing the librispeech data\
     in order to train the ngram language model."""
-from typing import Union
+from typing import Union, Optional, Iterable, Iterator, List
 from pathlib import Path
+from itertools import islice
 import re
 from argparse import ArgumentParser
 import logging
 from tqdm import tqdm
-import phonemizer
+from phonemization import PhonemesCache, phonemize as phonemize_utterances
 
 LOGGER = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
-def get_utterances(input_folder: Path, output_folder: Path) -> None:
-    """Creating the file containing librispeech utterances."""
+def get_utterances(input_folder: Path) -> Iterator[str]:
+    """Iterates over the librispeech utterances."""
     LOGGER.info("Getting utterances...")
     transcriptions = list(input_folder.rglob("*.trans.txt"))
-    with open(output_folder / "librispeech.orthographic", "w") as output_file:
-        for transcription in tqdm(transcriptions):
-            with open(transcription, "r") as transcription_file:
-                for line in transcription_file:
-                    utterance_id = re.findall(r"\d+\-\d+\-\d+", line)[0]
-                    line = re.sub(f"{utterance_id} ", "", line)
-                    line = line.lower().strip()
-                    output_file.write(f"{line}\n")
-
-def phonemize(inpu_file: Union[Path, str], output_folder: Path) -> None:
-    """Phonemizing orthographic utterances."""
-    separator = phonemizer.separator.Separator(phone=' ', word='  ')
-    with open(inpu_file, "r") as transcription_file:
-        utterances = [line.strip() for line in transcription_file]
+    for transcription in tqdm(transcriptions):
+        with open(transcription, "r") as transcription_file:
+            for line in transcription_file:
+                utterance_id = re.findall(r"\d+\-\d+\-\d+", line)[0]
+                line = re.sub(f"{utterance_id} ", "", line)
+                yield line.lower().strip()
+
+def write_utterances(utterances: Iterable[str], output_file: Union[Path, str]) -> Iterator[str]:
+    """Writes the utterances in a given file while passing them through."""
+    with open(output_file, "w") as orthographic_file:
+        for utterance in utterances:
+            orthographic_file.write(f"{utterance}\n")
+            yield utterance
+
+def read_utterances(input_file: Union[Path, str]) -> Iterator[str]:
+    """Iterates over the utterances of a given file."""
+    with open(input_file, "r") as transcription_file:
+        for line in transcription_file:
+            yield line.strip()
+
+def chunks(utterances: Iterable[str], chunk_size: int) -> Iterator[List[str]]:
+    """Groups the utterances into lists of `chunk_size` utterances."""
+    iterator = iter(utterances)
+    for first in iterator:
+        yield [first, *islice(iterator, chunk_size - 1)]
+
+def phonemize(utterances: Iterable[str],
+              output_folder: Path,
+              phonemes_cache: Optional[Path]=None,
+              jobs: int=1,
+              chunk_size: int=100000) -> None:
+    """
+    Phonemizing orthographic utterances. The utterances are streamed:\
+    they are phonemized and written by chunks of `chunk_size`, so that\
+    the memory does not grow with the size of the corpus.
+    """
     LOGGER.info("Phonemizing...")
-    phonemized = phonemizer.phonemize(text=utterances,
-                                      strip=True,
-                                      preserve_empty_lines=True,
-                                      language_switch="remove-flags",
-                                      separator=separator)
-    tokenized = [re.sub(" +", " ", utterance) for utterance in phonemized]
+    cache = PhonemesCache(phonemes_cache) if phonemes_cache is not None else None
     with open(output_folder / "librispeech.phonemized", "w") as output_file:
-        output_file.write("\n".join(tokenized))
+        for idx, chunk in enumerate(chunks(utterances, chunk_size)):
+            tokenized = phonemize_utterances(chunk, cache=cache, njobs=jobs)
+            if idx > 0:
+                output_file.write("\n")
+            output_file.write("\n".join(tokenized))
+            output_file.flush()
 
 def main():
     parser = ArgumentParser()
@@ -47,14 +70,35 @@ def main():
     parser.add_argument("-o", "--output_folder",
                         help="Where the output files will be saved.",
                         required=True)
+    parser.add_argument("-t", "--orthographic",
+                        help="The orthographic utterances to phonemize when no librispeech\
+                            folder is given. Default: [OUTPUT_FOLDER]/librispeech.orthographic")
+    parser.add_argument("-p", "--phonemes_cache",
+                        help="The sqlite database caching the phonemized utterances.",
+                        default="data/phonemes.sqlite")
+    parser.add_argument("-j", "--jobs",
+                        help="The number of phonemizer jobs.",
+                        type=int,
+                        default=1)
+    parser.add_argument("-s", "--chunk_size",
+                        help="The number of utterances phonemized and written at once.",
+                        type=int,
+                        default=100000)
 
     args = parser.parse_args()
     output_folder = Path(args.output_folder)
     output_folder.mkdir(exist_ok=True, parents=True)
 
     if args.input_folder is not None:
-        get_utterances(Path(args.input_folder), output_folder)
-    phonemize("data/ngram_lm/librispeech.orthographic", output_folder)
+        utterances = write_utterances(get_utterances(Path(args.input_folder)),
+                                      output_folder / "librispeech.orthographic")
+    else:
+        utterances = read_utterances(args.orthographic or output_folder / "librispeech.orthographic")
+    phonemize(utterances,
+              output_folder,
+              phonemes_cache=Path(args.phonemes_cache),
+              jobs=args.jobs,
+              chunk_size=args.chunk_size)
     
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,127 @@
+"""This module implements a batched, Whisper-compatible, log-mel frontend."""
+from typing import List, Union
+from argparse import ArgumentParser
+import logging
+import numpy as np
+import torch
+from torch import Tensor
+from torch import nn
+from transformers import AutoFeatureExtractor
+
+Array = Union[np.ndarray, Tensor]
+
+LOGGER = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+class LogMelSpectrogram(nn.Module):
+    """
+    Computes the Whisper log-mel features of a whole padded batch at once\
+    with `torch.stft`, instead of one utterance at a time in NumPy.
+
+    Parameters
+    ----------
+    - mel_filters: np.ndarray
+        The mel filterbank, of shape [n_mels, n_fft // 2 + 1].
+    - n_fft: int
+        The size of the Fourier transform. Default=400
+    - hop_length: int
+        The number of samples between two frames. Default=160
+    - n_samples: int
+        The number of samples of the 30 seconds inputs. Default=480000
+    """
+
+    def __init__(self,
+                 mel_filters: np.ndarray,
+                 n_fft: int=400,
+                 hop_length: int=160,
+                 n_samples: int=480000):
+        super().__init__()
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.n_samples = n_samples
+        self.register_buffer("window", torch.hann_window(n_fft))
+        self.register_buffer("mel_filters", torch.tensor(mel_filters, dtype=torch.float32))
+
+    @classmethod
+    def from_feature_extractor(cls, feature_extractor) -> "LogMelSpectrogram":
+        """Creates the frontend with the filterbank of a huggingface whisper feature extractor."""
+        mel_filters = np.asarray(feature_extractor.mel_filters)
+        # depending on the transformers version, the filters are stored as [n_freqs, n_mels]
+        if mel_filters.shape[0] == 1 + feature_extractor.n_fft // 2:
+            mel_filters = mel_filters.T
+        return cls(mel_filters,
+                   n_fft=feature_extractor.n_fft,
+                   hop_length=feature_extractor.hop_length,
+                   n_samples=feature_extractor.n_samples)
+
+    def pad(self, utterances: List[Array], longest: bool=False) -> Tensor:
+        """
+        Pads the utterances with zeros into a [batch_size, n_samples] tensor.
+        The utterances are padded to 30 seconds, or to the longest one if `longest`.
+        """
+        utterances = [torch.as_tensor(utterance[:self.n_samples], dtype=torch.float32)
+                      for utterance in utterances]
+        n_samples = max(len(utterance) for utterance in utterances) if longest else self.n_samples
+        waveforms = torch.zeros(len(utterances), n_samples)
+        for idx, utterance in enumerate(utterances):
+            waveforms[idx, :len(utterance)] = utterance
+        return waveforms
+
+    def forward(self, waveforms: Tensor) -> Tensor:
+        stft = torch.stft(waveforms,
+                          self.n_fft,
+                          self.hop_length,
+                          window=self.window,
+                          return_complex=True)
+        magnitudes = stft[..., :-1].abs() ** 2 # out dim: [batch_size, n_freqs, n_frames]
+        mel_spec = self.mel_filters @ magnitudes # out dim: [batch_size, n_mels, n_frames]
+        log_spec = torch.clamp(mel_spec, min=1e-10).log10()
+        # each utterance is normalized by its own maximum, as in Whisper
+        log_spec = torch.maximum(log_spec, log_spec.amax(dim=(1, 2), keepdim=True) - 8.0)
+        return (log_spec + 4.0) / 4.0
+
+def check_parity(checkpoint: str,
+                 n_utterances: int=16,
+                 sampling_rate: int=16000,
+                 tolerance: float=1e-3,
+                 seed: int=1797) -> float:
+    """
+    Compares the features of the torch frontend with the ones of the\
+    huggingface feature extractor on random waveforms, for both padding modes.
+    Returns the maximum absolute difference and raises if it exceeds the tolerance.
+    """
+    feature_extractor = AutoFeatureExtractor.from_pretrained(checkpoint)
+    log_mel = LogMelSpectrogram.from_feature_extractor(feature_extractor)
+    rng = np.random.default_rng(seed)
+    utterances = [rng.uniform(-0.5, 0.5, size=rng.integers(sampling_rate // 2, 8 * sampling_rate))
+                  for _ in range(n_utterances)]
+    max_difference = 0.0
+    for padding, longest in (("max_length", False), ("longest", True)):
+        expected = feature_extractor(utterances,
+                                     sampling_rate=sampling_rate,
+                                     padding=padding,
+                                     return_tensors="np")["input_features"]
+        with torch.no_grad():
+            computed = log_mel(log_mel.pad(utterances, longest=longest)).numpy()
+        assert expected.shape == computed.shape, f"Shapes mismatch: {expected.shape} and {computed.shape}"
+        difference = float(np.abs(expected - computed).max())
+        LOGGER.info(f"padding={padding}, max absolute difference={difference}")
+        max_difference = max(max_difference, difference)
+    assert max_difference <= tolerance, f"The torch frontend differs from the feature extractor by {max_difference}"
+    return max_difference
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("-c", "--checkpoint",
+                        help="The huggingface checkpoint of the feature extractor.",
+                        default="openai/whisper-base.en")
+    parser.add_argument("-t", "--tolerance",
+                        help="The maximum absolute difference allowed.",
+                        type=float,
+                        default=1e-3)
+
+    args = parser.parse_args()
+    check_parity(args.checkpoint, tolerance=args.tolerance)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""This module implements the manifest of a corpus: one typed parquet table of its utterances."""
+from typing import Union, List, Dict, Iterator, Optional, Sequence
+from pathlib import Path
+import csv
+import os
+import logging
+import pandas as pd
+from pandas import DataFrame
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+DataPath = Union[str, Path]
+
+LOGGER = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+MANIFEST_SUFFIX = ".manifest.parquet"
+SCHEMA = pa.schema([("utterance_id", pa.string()),
+                    ("audio_path", pa.string()),
+                    ("onset", pa.int64()), # in milliseconds, null if the utterance is the whole recording
+                    ("offset", pa.int64()),
+                    ("text", pa.string()),
+                    ("phones", pa.string()),
+                    ("entropy", pa.float64()),
+                    ("family", pa.string()),
+                    ("speaker", pa.string()),
+                    ("age", pa.float64())]) # in months
+DTYPES = {"utterance_id": str,
+          "audio_path": str,
+          "onset": "Int64",
+          "offset": "Int64",
+          "text": str,
+          "phones": str,
+          "entropy": float,
+          "family": str,
+          "speaker": str,
+          "age": float}
+# the tab-separated files written before the manifest, and their columns
+LEGACY_COLUMNS = {".paths": ["utterance_id", "audio_path", "onset", "offset"],
+                  ".segments": ["utterance_id", "text"],
+                  ".infos": ["utterance_id", "family", "speaker", "age"],
+                  ".entropies": ["utterance_id", "entropy"]}
+
+def corpus_name(path: DataPath) -> str:
+    """Returns the name of the corpus of a manifest, or of a legacy file."""
+    name = Path(path).name
+    if name.endswith(MANIFEST_SUFFIX):
+        return name[:-len(MANIFEST_SUFFIX)]
+    return Path(path).stem
+
+def manifest_path(folder: DataPath, name: str) -> Path:
+    """Returns the path of the manifest of a corpus."""
+    return Path(folder) / f"{name}{MANIFEST_SUFFIX}"
+
+def write_manifest(path: DataPath, columns: Dict[str, Sequence]) -> None:
+    """
+    Writes the manifest from its columns (the missing ones are null).
+    The manifest is replaced at once, so that readers never see it half-written.
+    """
+    length = len(columns["utterance_id"])
+    arrays = [pa.array(columns[field.name], type=field.type, from_pandas=True)
+              if field.name in columns else pa.nulls(length, type=field.type)
+              for field in SCHEMA]
+    table = pa.Table.from_arrays(arrays, schema=SCHEMA)
+    pq.write_table(table, f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+
+def update_manifest(path: DataPath, columns: Dict[str, Sequence]) -> None:
+    """Sets the values of some columns for the utterances given in `columns["utterance_id"]`."""
+    manifest = read_manifest(path)
+    updates = DataFrame(columns).set_index("utterance_id")
+    manifest = manifest.set_index("utterance_id")
+    for column in updates.columns:
+        manifest.loc[updates.index, column] = updates[column].astype(manifest[column].dtype)
+    write_manifest(path, {"utterance_id": manifest.index, **{column: manifest[column] for column in manifest.columns}})
+
+def read_manifest(path: DataPath, columns: Optional[List[str]]=None) -> DataFrame:
+    """Reads the given columns (all by default) of a manifest."""
+    return pq.read_table(path, columns=columns).to_pandas()
+
+def read_legacy(path: DataPath, chunk_size: Optional[int]=None) -> Union[DataFrame, Iterator[DataFrame]]:
+    """Reads a tab-separated file (`.paths`, `.segments`, `.infos` or `.entropies`)."""
+    names = LEGACY_COLUMNS[Path(path).suffix]
+    return pd.read_csv(path,
+                       sep="\t",
+                       header=None,
+                       names=names,
+                       dtype={name: DTYPES[name] for name in names},
+                       quoting=csv.QUOTE_NONE,
+                       keep_default_na=False,
+                       na_values={"onset": [""], "offset": [""], "age": [""]},
+                       skip_blank_lines=True,
+                       float_precision="round_trip",
+                       chunksize=chunk_size)
+
+def _source(path: DataPath) -> Path:
+    """The manifest of the corpus of a legacy file is read instead of it when it exists."""
+    path = Path(path)
+    if path.name.endswith(MANIFEST_SUFFIX):
+        return path
+    manifest = manifest_path(path.parent, corpus_name(path))
+    return manifest if manifest.exists() else path
+
+def read_columns(path: DataPath, columns: List[str]) -> DataFrame:
+    """
+    Reads some columns of the utterances of a corpus, given its manifest\
+    or one of its legacy tab-separated files.
+    """
+    path = _source(path)
+    if path.name.endswith(MANIFEST_SUFFIX):
+        return read_manifest(path, columns)
+    return read_legacy(path)[columns]
+
+def iter_columns(path: DataPath, columns: List[str], chunk_size: int=100000) -> Iterator[DataFrame]:
+    """Reads some columns of the utterances of a corpus by chunks of `chunk_size` rows."""
+    path = _source(path)
+    if path.name.endswith(MANIFEST_SUFFIX):
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+        return
+    for chunk in read_legacy(path, chunk_size):
+        yield chunk[columns]
+
+def find_manifest(folder: DataPath) -> Path:
+    """
+    Returns the manifest of the corpus prepared in a folder. A corpus prepared\
+    before the manifest existed is converted from its tab-separated files.
+    """
+    manifests = list(Path(folder).glob(f"*{MANIFEST_SUFFIX}"))
+    if manifests:
+        return manifests[0]
+    paths = next(Path(folder).glob("*.paths"))
+    LOGGER.info(f"Converting the tab-separated files of {corpus_name(paths)} into a manifest...")
+    manifest = read_legacy(paths)
+    for suffix in (".segments", ".infos", ".entropies"):
+        if paths.with_suffix(suffix).exists():
+            manifest = manifest.merge(read_legacy(paths.with_suffix(suffix)), on="utterance_id", how="left")
+    path = manifest_path(folder, corpus_name(paths))
+    write_manifest(path, {column: manifest[column] for column in manifest.columns})
+    return path
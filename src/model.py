@@ -1,4 +1,5 @@
 """Module that implement a model that predict text entropies from whisper features."""
+from typing import Optional, Tuple, Union
 from math import sqrt
 import random
 import torch
@@ -9,21 +10,114 @@ from transformers import WhisperModel
 torch.manual_seed(1797)
 random.seed(1797)
 
+def masked_mean(hidden_states: Tensor, lengths: Tensor) -> Tensor:
+    """Mean-pools [batch_size, seq_len, d_model] hidden states over the first `lengths` frames."""
+    positions = torch.arange(hidden_states.shape[1], device=hidden_states.device)
+    mask = (positions[None, :] < lengths[:, None]).to(hidden_states.dtype)
+    summed = (hidden_states * mask.unsqueeze(-1)).sum(1)
+    return summed / lengths.clamp(min=1).unsqueeze(-1).to(summed.dtype) # out dim: [batch_size, d_model]
+
 class EntropyWhisper(nn.Module):
-    """A model that predict text entropies from whisper features."""
-    def __init__(self, checkpoint):
+    """
+    A model that predict text entropies from whisper features.
+
+    Parameters
+    ----------
+    - checkpoint: str
+        The huggingface checkpoint of the whisper model.
+    - layer: int
+        The encoder layer whose hidden states are pooled, 0 being the input\
+        embeddings of the first layer (None means the last layer). Default=None
+    - probe: bool
+        Whether to pool the hidden states of all the layers in one forward,\
+        with one linear head per layer. Default=False
+    """
+    def __init__(self, checkpoint, layer: Optional[int]=None, probe: bool=False):
         super().__init__()
         self.whisper = WhisperModel.from_pretrained(checkpoint)
         for param in self.whisper.parameters():
             param.requires_grad = False
         d_model = self.whisper.config.d_model
-        self.w = nn.Parameter(torch.Tensor(d_model), requires_grad=True)
+        self.num_hidden_states = self.whisper.config.encoder_layers + 1
+        self.layer = layer
+        self.probe = probe
+        shape = (self.num_hidden_states, d_model) if probe else (d_model,)
+        self.w = nn.Parameter(torch.Tensor(*shape), requires_grad=True)
         nn.init.normal_(self.w, mean=0, std=sqrt(2 / (2 * d_model)))
-    
-    def forward(self, x: Tensor) -> Tensor:
+
+    @property
+    def pooling_name(self) -> str:
+        """Names the hidden states that are pooled."""
+        if self.probe:
+            return "all-layers"
+        if self.layer is None:
+            return "last-layer"
+        return f"layer-{self.layer}"
+
+    def encode(self,
+               x: Tensor,
+               output_hidden_states: bool=False) -> Union[Tensor, Tuple[Tensor, ...]]:
+        """
+        Runs the Whisper encoder on log-mel features of any length\
+        (at most 30 seconds). Whisper's encoder only accepts 30 seconds inputs,\
+        so the positional embeddings are trimmed to the length of the input.
+        With `output_hidden_states`, the hidden states of all the layers are\
+        returned, ordered as the `hidden_states` of huggingface's whisper encoder.
+        """
+        encoder = self.whisper.encoder
+        inputs_embeds = nn.functional.gelu(encoder.conv1(x))
+        inputs_embeds = nn.functional.gelu(encoder.conv2(inputs_embeds))
+        inputs_embeds = inputs_embeds.permute(0, 2, 1) # out dim: [batch_size, seq_len, d_model]
+        embed_pos = encoder.embed_positions.weight[:inputs_embeds.shape[1]]
+        hidden_states = inputs_embeds + embed_pos
+        all_hidden_states = []
+        for layer in encoder.layers:
+            all_hidden_states.append(hidden_states)
+            layer_outputs = layer(hidden_states, None, layer_head_mask=None)
+            # older transformers versions return a tuple
+            hidden_states = layer_outputs[0] if isinstance(layer_outputs, tuple) else layer_outputs
+        hidden_states = encoder.layer_norm(hidden_states)
+        if output_hidden_states:
+            return tuple(all_hidden_states) + (hidden_states,)
+        return hidden_states
+
+    def pool(self, x: Tensor, lengths: Optional[Tensor]=None) -> Tensor:
+        """
+        Mean-pools the frozen Whisper encoder representations of the input speech.
+        If the number of mel frames of each utterance is given, the features are\
+        encoded as they are (without padding to 30 seconds) and only the frames\
+        of the utterances are pooled.
+        In probing mode, all the layers are pooled from the same encoder forward.
+        """
         with torch.no_grad():
             # extract Whisper contextual representations of the input speech
-            whisper_outputs = self.whisper.encoder(x)
-            hidden_states = whisper_outputs.last_hidden_state # out dim: [batch_size, seq_len, d_model]
-        pooled = hidden_states.mean(1) # out dim: [batch_size, d_model]
-        return pooled @ self.w
\ No newline at end of file
+            if self.probe:
+                all_hidden_states = self.encode(x, output_hidden_states=True)
+            elif self.layer is not None:
+                all_hidden_states = (self.encode(x, output_hidden_states=True)[self.layer],)
+            elif lengths is None:
+                whisper_outputs = self.whisper.encoder(x)
+                all_hidden_states = (whisper_outputs.last_hidden_state,) # out dim: [batch_size, seq_len, d_model]
+            else:
+                all_hidden_states = (self.encode(x),)
+            if lengths is not None:
+                # the second convolution of the encoder has a stride of 2
+                lengths = (lengths.to(x.device) + 1) // 2
+            pooled = [hidden_states.mean(1) if lengths is None else masked_mean(hidden_states, lengths)
+                      for hidden_states in all_hidden_states] # out dim: [batch_size, d_model]
+        if self.probe:
+            return torch.stack(pooled, 1) # out dim: [batch_size, num_hidden_states, d_model]
+        return pooled[0]
+
+    def head(self, pooled: Tensor) -> Tensor:
+        """
+        Predicts the entropies from the pooled encoder representations.
+        In probing mode, returns the predictions of each layer's head,\
+        of shape [batch_size, num_hidden_states].
+        """
+        if self.probe:
+            return (pooled * self.w).sum(-1)
+        return pooled @ self.w
+
+    def forward(self, x: Tensor, lengths: Optional[Tensor]=None) -> Tensor:
+        return self.head(self.pool(x, lengths))
\ No newline at end of file
@@ -0,0 +1,101 @@
+"""Module for phonemizing utterances in parallel, with a persistent cache."""
+from typing import Union, List, Dict, Iterable, Optional
+from pathlib import Path
+import json
+import re
+import sqlite3
+import logging
+import phonemizer
+from phonemizer.backend import EspeakBackend
+
+CachePath = Union[str, Path]
+
+LOGGER = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+SEPARATOR = phonemizer.separator.Separator(phone=' ', word='  ')
+SETTINGS = {"language": "en-us",
+            "backend": "espeak",
+            "strip": True,
+            "preserve_empty_lines": True,
+            "language_switch": "remove-flags"}
+
+def normalize(utterance: str) -> str:
+    """Normalizes the whitespaces of an utterance, which do not change its phonemization."""
+    return " ".join(utterance.split())
+
+def settings_key() -> str:
+    """Returns a key identifying the phonemizer settings and versions."""
+    settings = dict(SETTINGS,
+                    phone_separator=SEPARATOR.phone,
+                    word_separator=SEPARATOR.word,
+                    phonemizer=phonemizer.__version__,
+                    espeak=".".join(map(str, EspeakBackend.version())))
+    return json.dumps(settings, sort_keys=True)
+
+class PhonemesCache:
+    """
+    A sqlite store mapping the normalized utterances to their phonemes,\
+    for a given phonemizer backend settings.
+
+    Parameters
+    ----------
+    - path: str, Path
+        Path to the sqlite database.
+    """
+
+    def __init__(self, path: CachePath):
+        Path(path).parent.mkdir(exist_ok=True, parents=True)
+        self.connection = sqlite3.connect(str(path))
+        self.connection.execute("CREATE TABLE IF NOT EXISTS phonemes"\
+                                "(settings TEXT, text TEXT, phones TEXT, PRIMARY KEY (settings, text))")
+        self.settings = settings_key()
+
+    def get(self, texts: List[str], query_size: int=500) -> Dict[str, str]:
+        """Returns the cached phonemes of the given texts."""
+        found = dict()
+        for start in range(0, len(texts), query_size):
+            chunk = texts[start:start + query_size]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.connection.execute("SELECT text, phones FROM phonemes"\
+                                           f" WHERE settings = ? AND text IN ({placeholders})",
+                                           [self.settings, *chunk])
+            found.update(rows)
+        return found
+
+    def put(self, phonemized: Dict[str, str]) -> None:
+        """Stores the phonemes of the given texts."""
+        self.connection.executemany("INSERT OR REPLACE INTO phonemes VALUES (?, ?, ?)",
+                                    ((self.settings, text, phones) for text, phones in phonemized.items()))
+        self.connection.commit()
+
+def phonemize_texts(texts: List[str], njobs: int=1) -> List[str]:
+    """Phonemizes the texts with espeak and tokenizes the phones."""
+    phonemized = phonemizer.phonemize(text=texts,
+                                      njobs=njobs,
+                                      separator=SEPARATOR,
+                                      **SETTINGS)
+    return [re.sub(" +", " ", utterance) for utterance in phonemized]
+
+def phonemize(utterances: Iterable[str],
+              cache: Optional[PhonemesCache]=None,
+              njobs: int=1,
+              chunk_size: int=10000) -> List[str]:
+    """
+    Phonemizes the utterances. Only the distinct utterances that are not\
+    in the cache are sent to espeak, by chunks of `chunk_size`, using `njobs` jobs.
+    Each chunk is cached as soon as it is phonemized.
+    """
+    normalized = [normalize(utterance) for utterance in utterances]
+    texts = list(dict.fromkeys(text for text in normalized if text))
+    phonemized = cache.get(texts) if cache is not None else dict()
+    unseen = [text for text in texts if text not in phonemized]
+    LOGGER.info(f"Phonemizing {len(unseen)} unseen utterances"\
+                f" ({len(texts) - len(unseen)} distinct utterances were cached)...")
+    for start in range(0, len(unseen), chunk_size):
+        chunk = unseen[start:start + chunk_size]
+        chunk_phonemized = dict(zip(chunk, phonemize_texts(chunk, njobs)))
+        if cache is not None:
+            cache.put(chunk_phonemized)
+        phonemized.update(chunk_phonemized)
+    return [phonemized[text] if text else "" for text in normalized]
@@ -2,19 +2,25 @@
 from pathlib import Path
 from argparse import ArgumentParser
 from tqdm import tqdm
+from manifest import manifest_path, write_manifest
 
 def prepare(childes_folder: Path, output_folder: Path):
     """
-    Prepares the input files for a given childes corpus.
-    It will create the utterances file, their audio paths\
+    Prepares the manifest of a given childes corpus.
+    It will contain the utterances, their audio paths\
     and the informations (i.e: for each utterance, who speaks\
     and at which age).
     """
     output_filename = childes_folder.stem
     children = list(childes_folder.glob("cleaned/*/"))
-    utterances_paths = [] # will contain all the audio path, and the onsets/offsets corresponding to each utterance.
-    utterances_segments = [] # will map each audio utterance to its orthographic version.
-    utterances_informations = [] # will contain the family, speaker, age, for each produced utterance.
+    columns = {"utterance_id": [], # the audio path, and the onset/offset corresponding to each utterance.
+               "audio_path": [],
+               "onset": [],
+               "offset": [],
+               "text": [], # maps each audio utterance to its orthographic version.
+               "family": [], # the family, speaker, age, for each produced utterance.
+               "speaker": [],
+               "age": []}
 
     for child in tqdm(children):
         child_name = child.stem
@@ -45,15 +51,15 @@ def prepare(childes_folder: Path, output_folder: Path):
                 if not orthographic and childes_folder.stem == "Thomas":
                     continue
                 path = f"{child_name}/{filename}" if len(children) > 1 else filename
-                utterances_paths.append(f"{utterance_id}\t{path}.wav\t{onset}\t{offset}")
-                utterances_segments.append(f"{utterance_id}\t{orthographic}")
-                utterances_informations.append(f"{utterance_id}\t{child_name}\t{target_speaker}\t{months}")
-    with open(output_folder / f"{output_filename}.paths", "w") as paths_file:
-        paths_file.write("\n".join(utterances_paths))
-    with open(output_folder / f"{output_filename}.segments", "w") as segments_file:
-        segments_file.write("\n".join(utterances_segments))
-    with open(output_folder / f"{output_filename}.infos", "w") as infos_file:
-        infos_file.write("\n".join(utterances_informations))
+                columns["utterance_id"].append(utterance_id)
+                columns["audio_path"].append(f"{path}.wav")
+                columns["onset"].append(int(onset))
+                columns["offset"].append(int(offset))
+                columns["text"].append(orthographic)
+                columns["family"].append(child_name)
+                columns["speaker"].append(target_speaker)
+                columns["age"].append(float(months))
+    write_manifest(manifest_path(output_folder, output_filename), columns)
 
 def main():
     parser = ArgumentParser()
@@ -1,9 +1,9 @@
 """Module for preparing the HuBERT CSVs results for plotting and modelling."""
-from tqdm import tqdm
 from pathlib import Path
 from argparse import ArgumentParser
-import pandas as pd
-import pylangacq
+import os
+from chat_index import ChatIndex
+from analysis_table import hubert_informations, build_table
 
 def get_args():
     parser = ArgumentParser()
@@ -11,49 +11,21 @@ def get_args():
                         help="The csv results of the HuBERT experience.")
     parser.add_argument("-c", "--childes_providence",
                         help="Path to childes providence corpus.")
-    
+    parser.add_argument("-j", "--jobs",
+                        help="The number of processes indexing the ages of the cha files.",
+                        type=int,
+                        default=os.cpu_count())
+
     return parser.parse_args()
 
-def age_and_families_columns(results, childes_folder):
+def age_and_families_columns(results, cha_index):
     """Creates the column age and family in the CSV."""
-    ages = []
-    families = []
-
-    results_groups = results.sort_values(by=['file_name'])
-    results_groups = results.groupby("file_name").groups
-    for group in tqdm(results_groups):
-        filename = Path(group)
-        if "-" in filename.stem:
-            child, filename = str(Path(filename).stem).split("-")
-        else:
-            child, filename = filename.parent.stem, filename.stem
-        filename += ".cha"
-        filename = childes_folder / child / filename
-        cha = pylangacq.read_chat(str(filename))
-        age = cha.ages(months=True)[0]
-        if age == 0.0:
-            continue
-        ages.extend([age] * len(results_groups[group]))
-        families.extend([child] * len(results_groups[group]))
-    results["age"] = ages
-    results["family"] = families
-    return results
-
+    return hubert_informations(results, cha_index)
 
 def main():
     args = get_args()
-    hubert_results = pd.read_csv(args.input_csv)
-
-    hubert_results.loc[(hubert_results["segment_speaker"] == "CHI"), "segment_speaker"] = "Target_Child"
-    hubert_results.loc[(hubert_results["segment_speaker"] == "FEM"), "segment_speaker"] = "Mother"
-
-    results = age_and_families_columns(hubert_results,
-                                       Path(args.childes_providence) / "annotations" / "cha" / "raw")
-
-    results = results.rename(columns={"segment_speaker": "speaker"})
-    results = results[results['speaker'].map(lambda x: x in {"Mother", "Target_Child"})]
-    results = results.groupby(["family", "speaker", "age"]).mean()
-    results.drop("Unnamed: 0", axis=1, inplace=True)
+    cha_index = ChatIndex(Path(args.childes_providence) / "annotations" / "cha" / "raw", jobs=args.jobs)
+    results = build_table(args.input_csv, cha_index=cha_index)
 
     output_filename = Path(args.input_csv).stem
     results.to_csv(f"results/{output_filename}_analysis.csv")
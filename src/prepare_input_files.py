@@ -1,16 +1,21 @@
 """Module for preparing input files for the model."""
-from typing import Union, List
+from typing import Union, List, Tuple, Iterator, Optional
 from math import log
 from pathlib import Path
 from argparse import ArgumentParser
-from itertools import tee
-import re
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import Pool
 import logging
-import phonemizer
+import numpy as np
+import pandas as pd
 import kenlm
-import h5py
 import soundfile as sf
 from tqdm import tqdm
+from audio_store import audio_writer
+from phonemization import PhonemesCache, phonemize
+from durations_index import durations_path, write_durations
+from manifest import corpus_name, find_manifest, read_columns, update_manifest
 
 LOGGER = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
@@ -19,67 +24,185 @@ def wavform(audio_path: Path):
     """Reads audio as waveform."""
     return sf.read(audio_path)
 
-def h5_dataset(utterances_paths: Path, audio_folder: Path, output_folder: Path):
-    """Creates h5py data for the dataloader."""
+Segment = Tuple[str, List[int]] # an utterance id and its (optional) onset and offset, in milliseconds
+
+def read_segments(audio_path: Path, segments: List[Segment]) -> Tuple[int, List[Tuple[str, np.ndarray]]]:
+    """
+    Decodes a recording and cuts the given segments from it.
+    Returns the sampling rate of the recording and the segments audios.
+    """
+    audio, sr = wavform(audio_path)
+    utterances = []
+    for utterance_id, timemarks in segments:
+        if timemarks:
+            raw_onset, raw_offset = timemarks
+            onset = int(raw_onset) / 1000
+            offset = int(raw_offset) / 1000
+            onset = int(onset * sr)
+            offset = int(offset * sr)
+            utterance = audio[onset:offset]
+        else:
+            utterance = audio
+        utterances.append((utterance_id, utterance))
+    return sr, utterances
+
+def decoded_recordings(recordings: dict,
+                       jobs: int=1) -> Iterator[Tuple[int, List[Tuple[str, np.ndarray]]]]:
+    """
+    Decodes the recordings in a pool of processes, yielding their segments\
+    in the order of `recordings`. At most two recordings per process are\
+    decoded in advance, so that the memory stays bounded.
+    """
+    if jobs <= 1:
+        for audio_path, segments in recordings.items():
+            yield read_segments(audio_path, segments)
+        return
+    with ProcessPoolExecutor(jobs) as pool:
+        pending = deque()
+        for audio_path, segments in recordings.items():
+            pending.append(pool.submit(read_segments, audio_path, segments))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def h5_dataset(manifest: Path,
+               audio_folder: Path,
+               output_folder: Path,
+               audio_format: str="hdf5",
+               jobs: int=1,
+               resume: bool=False):
+    """
+    Creates the audio data for the dataloader: a h5py file ("hdf5" format)\
+    or a memory-mapped array of samples with its index ("mmap" format).
+    The utterances are grouped by recording, so that each recording is\
+    decoded only once, and the recordings are decoded by `jobs` processes.
+    With `resume`, the utterances already written by a previous run are kept\
+    and the recordings whose utterances are all written are not decoded again.
+    The utterances are sorted by duration in the `.sorted` file, and their\
+    durations (with their family, speaker and age, if the corpus has them)\
+    are written in the `.durations` index.
+    """
     output_folder.mkdir(exist_ok=True, parents=True)
-    f = h5py.File(output_folder / f"{utterances_paths.stem}.hdf5", 'w')
-    already_opened = dict()
+    name = corpus_name(manifest)
+    writer = audio_writer(output_folder, name, audio_format, resume)
+    utterances_df = read_columns(manifest, ["utterance_id", "audio_path", "onset", "offset",
+                                            "family", "speaker", "age"])
+    recordings = defaultdict(list)
+    for utterance_id, audio_path, onset, offset in zip(utterances_df["utterance_id"],
+                                                       utterances_df["audio_path"],
+                                                       utterances_df["onset"],
+                                                       utterances_df["offset"]):
+        timemarks = [] if pd.isna(onset) else [onset, offset]
+        recordings[audio_folder / audio_path].append((utterance_id, timemarks))
     sorted_utterances = []
-    LOGGER.info("Creating h5 dataset...")
-    with open(utterances_paths, "r") as audio_paths:
-        copied_audio_paths, audio_paths = tee(audio_paths, 2)
-        total = sum(1 for _ in copied_audio_paths)
-        for line in tqdm(audio_paths, total=total):
-            informations = line.strip().split("\t")
-            utterance_id, audio_path, *timemarks = informations
-            audio_path = audio_folder / audio_path
-            if audio_path in already_opened:
-                audio, sr = already_opened[audio_path]
-            else:
-                already_opened.clear()
-                audio, sr = wavform(audio_path)
-                already_opened[audio_path] = (audio, sr)
-            if timemarks:
-                raw_onset, raw_offset = timemarks
-                onset = int(raw_onset) / 1000
-                offset = int(raw_offset) / 1000
-                onset = int(onset * sr)
-                offset = int(offset * sr)
-                utterance = audio[onset:offset]
-            else:
-                utterance = audio
-            sorted_utterances.append((audio.shape[0], utterance_id))
-            f.create_dataset(utterance_id, data=utterance)
+    to_decode = dict()
+    for audio_path, segments in recordings.items():
+        missing = [segment for segment in segments if segment[0] not in writer]
+        if missing:
+            to_decode[audio_path] = missing
+            continue
+        # already written: only the sampling rate of the recording is needed
+        sampling_rate = sf.info(str(audio_path)).samplerate
+        sorted_utterances.extend((writer.num_samples(utterance_id), utterance_id, sampling_rate)
+                                 for utterance_id, _ in segments)
+    LOGGER.info(f"Creating {audio_format} dataset from {len(to_decode)} recordings"\
+                f" ({len(recordings) - len(to_decode)} already done)...")
+    bar = tqdm(total=sum(len(segments) for segments in to_decode.values()))
+    decoded = decoded_recordings(to_decode, jobs)
+    for audio_path, (sampling_rate, utterances) in zip(to_decode, decoded):
+        for utterance_id, utterance in utterances:
+            writer.write(utterance_id, utterance)
+        writer.flush()
+        sorted_utterances.extend((writer.num_samples(utterance_id), utterance_id, sampling_rate)
+                                 for utterance_id, _ in recordings[audio_path])
+        bar.update(len(utterances))
+    writer.close()
     sorted_utterances = sorted(sorted_utterances)
-    _, ids = zip(*sorted_utterances)
-    with open(output_folder / f"{utterances_paths.stem}.sorted", 'w') as sorted_paths_file:
+    _, ids, _ = zip(*sorted_utterances)
+    sorted_path = output_folder / f"{name}.sorted"
+    with open(sorted_path, 'w') as sorted_paths_file:
         for id in ids:
             sorted_paths_file.write(f"{id}\n")
+    known = utterances_df.dropna(subset=["speaker"])
+    informations = dict(zip(known["utterance_id"],
+                            zip(known["family"], known["speaker"], known["age"].astype(str))))
+    write_durations(durations_path(sorted_path),
+                    [(utterance_id, samples / sampling_rate)
+                     for samples, utterance_id, sampling_rate in sorted_utterances],
+                    informations)
 
 def compute_entropy(model: kenlm.Model, utterance: Union[str, List[str]]) -> float:
     """Computes the entropy of a given utterance from a given model."""
     ppl = model.perplexity(utterance)
     return log(ppl)
 
-def entropies_file(utterances_segments: Path,
+def compute_surprisals(model: kenlm.Model, utterance: str) -> np.ndarray:
+    """
+    Computes the surprisal (in nats) of each phone of a given utterance,\
+    and of the end of the utterance. Their mean is the entropy of the utterance.
+    """
+    log10_probabilities = [log10_probability for log10_probability, _, _ in model.full_scores(utterance)]
+    return -np.array(log10_probabilities, dtype=np.float64) * log(10)
+
+_MODEL = None
+
+def _load_model(ngram_model_path: str) -> None:
+    """Loads the ngram model of a scoring process."""
+    global _MODEL
+    _MODEL = kenlm.Model(ngram_model_path)
+
+def _score(utterance: str) -> np.ndarray:
+    """Computes the surprisals of an utterance with the model of the scoring process."""
+    return compute_surprisals(_MODEL, utterance)
+
+def score_utterances(utterances: List[str],
+                     ngram_model_path: str,
+                     jobs: int=1,
+                     chunksize: int=1000) -> Iterator[np.ndarray]:
+    """
+    Computes the surprisals of the utterances, in the order of `utterances`.
+    The utterances are split across `jobs` processes, each with its own model.
+    """
+    if jobs <= 1:
+        _load_model(ngram_model_path)
+        yield from map(_score, utterances)
+        return
+    with Pool(jobs, initializer=_load_model, initargs=(ngram_model_path,)) as pool:
+        yield from pool.imap(_score, utterances, chunksize=chunksize)
+
+def entropies_file(manifest: Path,
                    ngram_model_path: str,
-                   output_folder: Path) -> None:
-    """Creates targets (entropies)."""
-    model = kenlm.Model(ngram_model_path)
-    separator = phonemizer.separator.Separator(phone=' ', word='  ')
-    LOGGER.info("Creating targets file (entropies)...")
-    with open(utterances_segments, "r") as text_file:
-        ids, utterances = zip(*[line.split("\t") for line in text_file])
-        phonemized = phonemizer.phonemize(text=utterances,
-                                          strip=True,
-                                          preserve_empty_lines=True,
-                                          language_switch="remove-flags",
-                                          separator=separator)
-    tokenized = [re.sub(" +", " ", utterance) for utterance in phonemized]
-    entropies = [compute_entropy(model, utterance) for utterance in tokenized]
-    with open(output_folder / f"{utterances_segments.stem}.entropies", "w") as entropies_file:
-        for id, entropy in zip(ids, entropies):
-            entropies_file.write(f"{id}\t{entropy}\n")
+                   output_folder: Path,
+                   phonemes_cache: Optional[Path]=None,
+                   jobs: int=1) -> None:
+    """
+    Creates targets (entropies), stored with the phones of the utterances\
+    in the manifest. The utterances already phonemized\
+    in a previous run are read from the phonemes cache.
+    The surprisal of each phone is also saved in a `.surprisals.npz` file:\
+    the surprisals of the i-th utterance of `ids` are\
+    `surprisals[offsets[i]:offsets[i + 1]]` (the last one being the end of utterance).
+    """
+    LOGGER.info("Creating targets (entropies)...")
+    segments = read_columns(manifest, ["utterance_id", "text"])
+    ids, utterances = segments["utterance_id"].tolist(), segments["text"].fillna("").tolist()
+    cache = PhonemesCache(phonemes_cache) if phonemes_cache is not None else None
+    tokenized = phonemize(utterances, cache=cache, njobs=jobs)
+    LOGGER.info("Scoring the utterances...")
+    offsets = [0]
+    surprisals = []
+    entropies = []
+    scores = score_utterances(tokenized, ngram_model_path, jobs)
+    for utterance_surprisals in tqdm(scores, total=len(ids)):
+        entropies.append(utterance_surprisals.mean())
+        surprisals.append(utterance_surprisals.astype(np.float32))
+        offsets.append(offsets[-1] + len(utterance_surprisals))
+    update_manifest(manifest, {"utterance_id": ids, "phones": tokenized, "entropy": entropies})
+    np.savez(output_folder / f"{corpus_name(manifest)}.surprisals.npz",
+             ids=np.array(ids),
+             offsets=np.array(offsets, dtype=np.int64),
+             surprisals=np.concatenate(surprisals))
 
 def main():
     parser = ArgumentParser()
@@ -92,14 +215,38 @@ def main():
     parser.add_argument("-m", "--ngram_model",
                         help="The path to the ngram model.",
                         required=True)
+    parser.add_argument("-f", "--audio_format",
+                        help="How the audios are stored: 'hdf5' (one dataset per utterance)\
+                            or 'mmap' (one memory-mapped array of samples).",
+                        choices=["hdf5", "mmap"],
+                        default="hdf5")
+    parser.add_argument("-p", "--phonemes_cache",
+                        help="The sqlite database caching the phonemized utterances.",
+                        default="data/phonemes.sqlite")
+    parser.add_argument("-j", "--jobs",
+                        help="The number of processes decoding the recordings, phonemizing\
+                            and scoring the utterances.",
+                        type=int,
+                        default=1)
+    parser.add_argument("-r", "--resume",
+                        help="Keep the audios already written by a previous (interrupted) run.",
+                        action="store_true")
 
     args = parser.parse_args()
     output_folder = Path(args.corpus) / "model_inputs"
     output_folder.mkdir(exist_ok=True, parents=True)
-    utterances_paths = next(output_folder.glob("*.paths"))
-    utterances_segments = next(output_folder.glob("*.segments"))
-    h5_dataset(utterances_paths, Path(args.audio_folder), output_folder)
-    entropies_file(utterances_segments, args.ngram_model, output_folder)
+    manifest = find_manifest(output_folder)
+    h5_dataset(manifest,
+               Path(args.audio_folder),
+               output_folder,
+               audio_format=args.audio_format,
+               jobs=args.jobs,
+               resume=args.resume)
+    entropies_file(manifest,
+                   args.ngram_model,
+                   output_folder,
+                   phonemes_cache=Path(args.phonemes_cache),
+                   jobs=args.jobs)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -4,11 +4,11 @@ from pathlib import Path
 from argparse import ArgumentParser
 import re
 from tqdm import tqdm
+from manifest import manifest_path, write_manifest
 
 def prepare(input_folder: Path, output_folder: Path):
-    """Creates files for """
-    utterances_paths = []
-    utterances_segments = []
+    """Creates the manifest of the utterances, their audio paths and their transcriptions."""
+    columns = {"utterance_id": [], "audio_path": [], "text": []}
     transcriptions = list(input_folder.rglob("*.trans.txt"))
     for transcription in tqdm(transcriptions):
         speech_folder = transcription.parent
@@ -17,13 +17,11 @@ def prepare(input_folder: Path, output_folder: Path):
                 utterance_id = re.findall(r"\d+\-\d+\-\d+", line)[0]
                 line = re.sub(f"{utterance_id} ", "", line)
                 line = line.lower().strip()
-                utterances_paths.append(f"{utterance_id}\t{speech_folder.parent.stem}/{speech_folder.stem}/{utterance_id}.flac")
-                utterances_segments.append(f"{utterance_id}\t{line}")
+                columns["utterance_id"].append(utterance_id)
+                columns["audio_path"].append(f"{speech_folder.parent.stem}/{speech_folder.stem}/{utterance_id}.flac")
+                columns["text"].append(line)
     
-    with open(output_folder / f"librispeech.paths", "w") as paths_file:
-        paths_file.write("\n".join(utterances_paths))
-    with open(output_folder / f"librispeech.segments", "w") as segments_file:
-        segments_file.write("\n".join(utterances_segments))
+    write_manifest(manifest_path(output_folder, "librispeech"), columns)
 
 def main():
     parser = ArgumentParser()
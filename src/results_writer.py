@@ -0,0 +1,145 @@
+"""This module implements a writer flushing the scoring results to the disk as they come."""
+from typing import Union, Dict, List
+from pathlib import Path
+from io import StringIO
+import os
+import logging
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+ResultsPath = Union[str, Path]
+
+LOGGER = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+RESULTS_FORMATS = {".csv", ".parquet"}
+
+def parquet_parts(path: Path) -> List[Path]:
+    """Returns the complete parts of a parquet results folder, in writing order."""
+    return sorted(path.glob("part-*.parquet"))
+
+def read_results(path: ResultsPath) -> DataFrame:
+    """
+    Reads a results file, which can still be written by a running scoring.
+    A csv file has the index of the rows as first column, and a parquet\
+    results file is a folder of parts.
+    """
+    path = Path(path)
+    if path.suffix == ".parquet":
+        parts = parquet_parts(path) if path.is_dir() else [path]
+        if not parts:
+            return DataFrame()
+        return pd.concat([pd.read_parquet(part) for part in parts], ignore_index=True)
+    with open(path, "r") as results_file:
+        text = results_file.read()
+    # the last line can be half-written by a running scoring (the targets\
+    # can be missing, so an incomplete row is not recognized by its NaNs)
+    text = text[:text.rfind("\n") + 1]
+    if not text:
+        return DataFrame()
+    return pd.read_csv(StringIO(text),
+                       index_col=0,
+                       dtype={"utterance_id": str},
+                       float_precision="round_trip")
+
+class ResultsWriter:
+    """
+    Writes the results column by column, and flushes them to the disk\
+    by record batches, so that the results are never all held in memory\
+    and can be read (with `read_results`) before the end of the scoring.
+
+    A csv file gets one text block appended per record batch, with the index\
+    of the rows as first column, like `DataFrame.to_csv`. A parquet file is\
+    a folder where each record batch is written as a new part.
+
+    Parameters
+    ----------
+    - path: str, Path
+        The results file, with '.csv' or '.parquet' as extension.
+    - batch_size: int
+        The number of rows buffered before being written. Default=10000
+    - resume: bool
+        Whether to append to the rows already written. Otherwise,\
+        the results file is overwritten. Default=False
+    """
+
+    def __init__(self, path: ResultsPath, batch_size: int=10000, resume: bool=False):
+        self.path = Path(path)
+        self.format = self.path.suffix
+        assert self.format in RESULTS_FORMATS, f"Unknown results format {self.format}"
+        self.batch_size = batch_size
+        self.buffers: Dict[str, List[np.ndarray]] = dict()
+        self.buffered = 0
+        self.rows = 0
+        self.parts = 0
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        if self.format == ".parquet":
+            self.path.mkdir(exist_ok=True)
+            for part in parquet_parts(self.path):
+                if resume:
+                    self.rows += len(pd.read_parquet(part, columns=[]))
+                    self.parts += 1
+                else:
+                    part.unlink()
+        elif resume and self.path.exists():
+            self.rows = self.load_csv()
+        elif self.path.exists():
+            self.path.unlink()
+
+    def load_csv(self) -> int:
+        """
+        Drops the last line of the csv file if a crash left it incomplete,\
+        and returns the number of rows already written.
+        """
+        with open(self.path, "r") as results_file:
+            lines = results_file.readlines()
+        complete = [line for line in lines if line.endswith("\n")]
+        if len(complete) < len(lines):
+            with open(self.path, "w") as results_file:
+                results_file.write("".join(complete))
+        return max(0, len(complete) - 1)
+
+    def write(self, **columns: np.ndarray) -> None:
+        """Buffers rows given as columns of equal lengths."""
+        lengths = {len(column) for column in columns.values()}
+        assert len(lengths) == 1, "The columns must have the same length"
+        for name, column in columns.items():
+            self.buffers.setdefault(name, []).append(np.asarray(column))
+        self.buffered += lengths.pop()
+        if self.buffered >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes the buffered rows to the disk."""
+        if not self.buffered:
+            return
+        batch = DataFrame({name: np.concatenate(column) for name, column in self.buffers.items()},
+                          index=pd.RangeIndex(self.rows, self.rows + self.buffered))
+        if self.format == ".parquet":
+            part = self.path / f"part-{self.parts:05d}.parquet"
+            # the part is renamed once complete, so readers never see it half-written
+            batch.to_parquet(f"{part}.tmp", index=False)
+            os.replace(f"{part}.tmp", part)
+            self.parts += 1
+        else:
+            header = not self.path.exists() or os.path.getsize(self.path) == 0
+            with open(self.path, "a") as results_file:
+                results_file.write(batch.to_csv(header=header))
+        self.rows += self.buffered
+        self.buffers = dict()
+        self.buffered = 0
+
+    def close(self) -> None:
+        """Writes the remaining rows."""
+        self.flush()
+
+    def __enter__(self) -> "ResultsWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+def results_path(output_folder: Path, name: str, results_format: str="csv") -> Path:
+    """Returns the path of a results file of a given format ("csv" or "parquet")."""
+    return output_folder / f"{name}.{results_format}"
@@ -1,11 +1,18 @@
 """A basic trainer for the entropy predictor model."""
 from data_loader import DataLoader
 from model import EntropyWhisper
+from embeddings_cache import EmbeddingsCache, sources_key
+from instrumentation import Instrumentation
+from typing import Iterator, List, Optional, Tuple, Sequence
 from pathlib import Path
 from argparse import ArgumentParser
+from itertools import product
+from math import sqrt
 import random
 import logging
 import torch
+from torch import nn
+from pandas import DataFrame
 from tqdm import tqdm
 import yaml
 
@@ -15,6 +22,59 @@ random.seed(1797)
 LOGGER = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
+def fill_cache(model: EntropyWhisper,
+               device: torch.device,
+               data_loader: DataLoader,
+               cache: EmbeddingsCache,
+               batch_size: int=32,
+               instrumentation: Optional[Instrumentation]=None) -> None:
+    """
+    Runs the frozen encoder once on the utterances missing from the cache.
+    With an instrumentation, the pass is recorded as the epoch of a `fill_cache` phase.
+    """
+    instrumentation = instrumentation or Instrumentation()
+    missing = cache.missing(data_loader.ids)
+    LOGGER.info(f"Caching the encoder features of {len(missing)} utterances...")
+    instrumentation.begin("fill_cache")
+    bar = tqdm(total=len(missing))
+    for batch in instrumentation.iterate(data_loader(batch_size, ids=missing)):
+        instrumentation.add_batch(batch)
+        with instrumentation.stage("encoder"):
+            pooled = model.pool(batch.x.to(device), batch.lengths)
+        with instrumentation.stage("cache_write"):
+            cache.put(batch.utterance_ids, pooled)
+        bar.update(batch.x.shape[0])
+        instrumentation.step()
+    instrumentation.epoch()
+
+def pooled_batches(model: EntropyWhisper,
+                   device: torch.device,
+                   data_loader: DataLoader,
+                   batch_size: int=32,
+                   cache: Optional[EmbeddingsCache]=None,
+                   epoch: int=0,
+                   instrumentation: Optional[Instrumentation]=None
+                   ) -> Iterator[Tuple[torch.Tensor, torch.Tensor, List[str]]]:
+    """
+    Iterates over the pooled encoder features of the batches and their targets.
+    The features are read from the cache when one is given, otherwise\
+    the encoder is run on the batch.
+    """
+    instrumentation = instrumentation or Instrumentation()
+    if cache is None:
+        for batch in instrumentation.iterate(data_loader(batch_size, epoch=epoch)):
+            instrumentation.add_batch(batch)
+            with instrumentation.stage("encoder"):
+                pooled = model.pool(batch.x.to(device), batch.lengths)
+            yield pooled, batch.y, batch.utterance_ids
+        return
+    for utterance_ids in data_loader.id_batches(batch_size, epoch=epoch):
+        with instrumentation.stage("cache_read"):
+            pooled = cache.get(utterance_ids).to(device)
+        if instrumentation.enabled:
+            instrumentation.add(len(utterance_ids), sum(map(data_loader.duration, utterance_ids)))
+        yield pooled, data_loader.targets(utterance_ids), utterance_ids
+
 def train(model: EntropyWhisper,
           device: torch.device,
           output_path: Path,
@@ -22,32 +82,67 @@ def train(model: EntropyWhisper,
           model_name: str="model",
           batch_size: int=32,
           epochs=5,
-          lr: int=0.00056) -> None:
-    """Train the model to predict text entropies from spoken utterances."""
+          lr: int=0.00056,
+          cache: Optional[EmbeddingsCache]=None,
+          instrumentation: Optional[Instrumentation]=None) -> None:
+    """
+    Train the model to predict text entropies from spoken utterances.
+    If a cache is given, the encoder is only run on the utterances\
+    that are not cached yet, and the epochs only read the cached features.
+    In probing mode, the heads of all the layers are trained together\
+    on the same pooled features, and each head is saved at its best epoch.
+    With an instrumentation, the stages of each step and each epoch are recorded.
+    """
+    instrumentation = instrumentation or Instrumentation()
     output_path.mkdir(exist_ok=True, parents=True)
     mse = torch.nn.MSELoss(reduction="mean")
     optimizer = torch.optim.Adam(model.parameters(), lr=lr)
     best_loss = float("Inf")
+    best_layer_losses = torch.full(model.w.shape[:-1], float("Inf"))
+    best_heads = model.w.detach().clone()
     total = 0
     logs = []
+    if cache is not None:
+        fill_cache(model, device, data_loader, cache, batch_size, instrumentation)
+    instrumentation.begin("train")
     for epoch in range(1, epochs + 1):
-        data_iterator = data_loader(batch_size)
+        data_iterator = pooled_batches(model, device, data_loader, batch_size, cache, epoch, instrumentation)
         bar = tqdm(total=data_loader.sample_size)
         epoch_losses = 0
-        for x, y, _ in data_iterator:
-            model.zero_grad()
-            x = x.to(device)
-            y = y.to(device)
-            predicted_entropy = model(x)
-            loss = mse(predicted_entropy.squeeze(-1), y)
-            loss.backward()
-            optimizer.step()
+        for pooled, y, _ in data_iterator:
+            with instrumentation.stage("head"):
+                model.zero_grad()
+                y = y.to(device)
+                predicted_entropy = model.head(pooled)
+                if model.probe:
+                    # the heads are independent, so summing their losses trains each one on its own loss
+                    layer_losses = ((predicted_entropy - y.unsqueeze(-1)) ** 2).mean(0)
+                    loss = layer_losses.sum()
+                else:
+                    loss = mse(predicted_entropy.squeeze(-1), y)
+            with instrumentation.stage("backward"):
+                loss.backward()
+                optimizer.step()
 
-            epoch_losses += loss.item()
+            epoch_losses += layer_losses.detach().cpu() if model.probe else loss.item()
             total += 1
-            bar.update(x.shape[0])
+            bar.update(pooled.shape[0])
+            instrumentation.step()
 
         epoch_loss = epoch_losses / total
+        instrumentation.epoch(loss=epoch_loss.tolist() if model.probe else epoch_loss)
+        if model.probe:
+            for layer, layer_loss in enumerate(epoch_loss.tolist()):
+                LOGGER.info(f"epoch={epoch}, layer={layer}, train loss={layer_loss}")
+            logs.append("\t".join(map(str, epoch_loss.tolist())))
+            improved = epoch_loss < best_layer_losses
+            best_layer_losses[improved] = epoch_loss[improved]
+            improved = improved.to(best_heads.device)
+            best_heads[improved] = model.w.detach()[improved]
+            state_dict = model.state_dict()
+            state_dict["w"] = best_heads
+            torch.save(state_dict, output_path / f"{model_name}.pt")
+            continue
         log = f"epoch={epoch}, train loss={epoch_loss}, lr={optimizer.param_groups[0]['lr']}"
         LOGGER.info(log)
         logs.append(str(epoch_loss))
@@ -56,6 +151,193 @@ def train(model: EntropyWhisper,
             torch.save(model.state_dict(), output_path / f"{model_name}.pt")
     with open(f"{model_name}.epochs", "w") as log_file:
         log_file.write("\n".join(logs))
+    instrumentation.close()
+
+def sweep(model: EntropyWhisper,
+          device: torch.device,
+          output_path: Path,
+          data_loader: DataLoader,
+          model_name: str="model",
+          batch_size: int=32,
+          epochs: int=5,
+          learning_rates: Sequence[float]=(0.00056,),
+          seeds: Sequence[int]=(1797,),
+          cache: Optional[EmbeddingsCache]=None,
+          instrumentation: Optional[Instrumentation]=None) -> DataFrame:
+    """
+    Trains one head per combination of learning rate and seed on the same\
+    pooled features, so the encoder (or the cache) is only read once per epoch\
+    for the whole grid. The seed of a head sets its initialization (the order\
+    of the batches is shared by all the heads).
+    The heads are stacked into a [d_model, n_heads] matrix and each one has\
+    its own Adam parameter group. Each head is saved at its best epoch as\
+    `[model_name]_sweep[head].pt` (without the frozen encoder), and the summary\
+    of the sweep is written to `[model_name].sweep.csv`.
+    With an instrumentation, the stages of each step and each epoch are recorded.
+    """
+    instrumentation = instrumentation or Instrumentation()
+    assert not model.probe, "The sweep trains the head of a single layer."
+    output_path.mkdir(exist_ok=True, parents=True)
+    grid = list(product(learning_rates, seeds))
+    d_model = model.w.shape[-1]
+    heads = nn.ParameterList()
+    for _, seed in grid:
+        generator = torch.Generator().manual_seed(seed)
+        head = torch.randn(d_model, generator=generator) * sqrt(2 / (2 * d_model))
+        heads.append(nn.Parameter(head.to(device)))
+    optimizer = torch.optim.Adam([{"params": [head], "lr": lr} for head, (lr, _) in zip(heads, grid)])
+    best_losses = torch.full((len(grid),), float("Inf"))
+    best_epochs = torch.zeros(len(grid), dtype=torch.long)
+    best_heads = torch.stack(list(heads)).detach().clone()
+    if cache is not None:
+        fill_cache(model, device, data_loader, cache, batch_size, instrumentation)
+    instrumentation.begin("sweep")
+    for epoch in range(1, epochs + 1):
+        bar = tqdm(total=data_loader.sample_size)
+        epoch_losses = torch.zeros(len(grid))
+        n_batches = 0
+        data_iterator = pooled_batches(model, device, data_loader, batch_size, cache, epoch, instrumentation)
+        for pooled, y, _ in data_iterator:
+            with instrumentation.stage("head"):
+                optimizer.zero_grad()
+                weights = torch.stack(list(heads), 1) # out dim: [d_model, n_heads]
+                predicted_entropies = pooled @ weights # out dim: [batch_size, n_heads]
+                # the heads are independent, so summing their losses trains each one on its own loss
+                losses = ((predicted_entropies - y.to(device).unsqueeze(-1)) ** 2).mean(0)
+            with instrumentation.stage("backward"):
+                losses.sum().backward()
+                optimizer.step()
+            epoch_losses += losses.detach().cpu()
+            n_batches += 1
+            bar.update(pooled.shape[0])
+            instrumentation.step()
+        epoch_losses /= n_batches
+        instrumentation.epoch(loss=epoch_losses.tolist())
+        for (lr, seed), loss in zip(grid, epoch_losses.tolist()):
+            LOGGER.info(f"epoch={epoch}, lr={lr}, seed={seed}, train loss={loss}")
+        improved = epoch_losses < best_losses
+        best_losses[improved] = epoch_losses[improved]
+        best_epochs[improved] = epoch
+        best_heads[improved.to(best_heads.device)] = torch.stack(list(heads)).detach()[improved.to(best_heads.device)]
+    checkpoints = []
+    for head, weights in enumerate(best_heads):
+        checkpoints.append(output_path / f"{model_name}_sweep{head}.pt")
+        # the frozen encoder is not saved with each head, only what rebuilds it
+        torch.save({"w": weights.clone(),
+                    "checkpoint": model.whisper.config.name_or_path,
+                    "layer": model.layer,
+                    "pooling": model.pooling_name},
+                   checkpoints[-1])
+    summary = DataFrame({"learning_rate": [lr for lr, _ in grid],
+                         "seed": [seed for _, seed in grid],
+                         "best_epoch": best_epochs.tolist(),
+                         "train_loss": best_losses.tolist(),
+                         "checkpoint": list(map(str, checkpoints))})
+    summary.to_csv(output_path / f"{model_name}.sweep.csv", index_label="head")
+    instrumentation.close()
+    best = summary["train_loss"].idxmin()
+    LOGGER.info(f"Best head: {best} (lr={summary['learning_rate'][best]}, seed={summary['seed'][best]})")
+    return summary
+
+def ridge_solutions(xtx: torch.Tensor, xty: torch.Tensor, alphas: Sequence[float]) -> torch.Tensor:
+    """
+    Solves the ridge systems (XᵀX + αI)w = Xᵀy of each head for all the alphas\
+    at once, with one eigendecomposition of each head's XᵀX.
+    XᵀX has shape [n_heads, d_model, d_model] and the solutions [n_alphas, n_heads, d_model].
+    """
+    eigenvalues, eigenvectors = torch.linalg.eigh(xtx)
+    projected = torch.einsum("hde,hd->he", eigenvectors, xty)
+    return torch.stack([torch.einsum("hde,he->hd", eigenvectors, projected / (eigenvalues + alpha))
+                        for alpha in alphas])
+
+def squared_errors(weights: torch.Tensor,
+                   xtx: torch.Tensor,
+                   xty: torch.Tensor,
+                   yty: torch.Tensor) -> torch.Tensor:
+    """Computes the sums of squared errors ||Xw - y||² of the heads' weights from XᵀX, Xᵀy and yᵀy."""
+    quadratic = torch.einsum("...hd,hde,...he->...h", weights, xtx, weights)
+    return quadratic - 2 * torch.einsum("...hd,hd->...h", weights, xty) + yty
+
+def ridge(model: EntropyWhisper,
+          device: torch.device,
+          output_path: Path,
+          data_loader: DataLoader,
+          model_name: str="model",
+          batch_size: int=32,
+          alphas: Sequence[float]=(0.1, 1.0, 10.0, 100.0, 1000.0),
+          validation: float=0.1,
+          seed: int=1797,
+          cache: Optional[EmbeddingsCache]=None,
+          instrumentation: Optional[Instrumentation]=None) -> List[float]:
+    """
+    Fits the linear head in closed form, as a ridge regression on the pooled\
+    encoder features. XᵀX and Xᵀy are accumulated in float64 in one pass over\
+    the data, separately for a held-out `validation` fraction of the utterances.
+    The alpha with the lowest validation loss is selected, and the head is\
+    refitted on all the utterances with it.
+    In probing mode, each layer's head gets its own alpha.
+    With an instrumentation, the stages of each step of the pass are recorded,\
+    and the pass with the solves is recorded as one epoch.
+    Returns the selected alphas (one per head).
+    """
+    instrumentation = instrumentation or Instrumentation()
+    output_path.mkdir(exist_ok=True, parents=True)
+    if cache is not None:
+        fill_cache(model, device, data_loader, cache, batch_size, instrumentation)
+    n_validation = int(len(data_loader.ids) * validation) if len(alphas) > 1 else 0
+    validation_ids = set(random.Random(seed).sample(data_loader.ids, n_validation))
+    d_model = model.w.shape[-1]
+    n_heads = model.w.shape[0] if model.probe else 1
+    xtx = torch.zeros(2, n_heads, d_model, d_model, dtype=torch.float64, device=device)
+    xty = torch.zeros(2, n_heads, d_model, dtype=torch.float64, device=device)
+    yty = torch.zeros(2, dtype=torch.float64, device=device)
+    bar = tqdm(total=data_loader.sample_size)
+    instrumentation.begin("ridge")
+    data_iterator = pooled_batches(model, device, data_loader, batch_size, cache, instrumentation=instrumentation)
+    for pooled, y, utterance_ids in data_iterator:
+        with instrumentation.stage("accumulate"):
+            pooled = pooled.double().view(pooled.shape[0], n_heads, d_model)
+            y = y.to(device).double()
+            held_out = torch.tensor([utterance_id in validation_ids for utterance_id in utterance_ids],
+                                    device=device)
+            # index 0 accumulates the training utterances, index 1 the validation ones
+            for split, mask in enumerate((~held_out, held_out)):
+                x, target = pooled[mask], y[mask]
+                xtx[split] += torch.einsum("bhd,bhe->hde", x, x)
+                xty[split] += torch.einsum("bhd,b->hd", x, target)
+                yty[split] += target @ target
+        bar.update(pooled.shape[0])
+        instrumentation.step()
+    logs = []
+    selected = torch.zeros(n_heads, dtype=torch.long)
+    if n_validation > 0:
+        with instrumentation.stage("solve"):
+            weights = ridge_solutions(xtx[0], xty[0], alphas)
+        train_losses = squared_errors(weights, xtx[0], xty[0], yty[0]) / (data_loader.sample_size - n_validation)
+        validation_losses = squared_errors(weights, xtx[1], xty[1], yty[1]) / n_validation
+        for head in range(n_heads):
+            layer = f"layer={head}, " if model.probe else ""
+            for alpha, train_loss, validation_loss in zip(alphas,
+                                                          train_losses[:, head].tolist(),
+                                                          validation_losses[:, head].tolist()):
+                LOGGER.info(f"{layer}alpha={alpha}, train loss={train_loss}, validation loss={validation_loss}")
+                logs.append("\t".join(map(str, ([head] if model.probe else []) + [alpha, train_loss, validation_loss])))
+        selected = validation_losses.argmin(0).cpu()
+    with instrumentation.stage("solve"):
+        weights = ridge_solutions(xtx.sum(0), xty.sum(0), alphas)[selected, torch.arange(n_heads)]
+    losses = squared_errors(weights, xtx.sum(0), xty.sum(0), yty.sum()) / data_loader.sample_size
+    selected_alphas = [alphas[index] for index in selected.tolist()]
+    instrumentation.epoch(alphas=selected_alphas, loss=losses.tolist())
+    instrumentation.close()
+    for head, (alpha, loss) in enumerate(zip(selected_alphas, losses.tolist())):
+        layer = f"layer={head}, " if model.probe else ""
+        LOGGER.info(f"{layer}Selected alpha={alpha}, train loss on all the utterances={loss}")
+    with torch.no_grad():
+        model.w.copy_(weights.view_as(model.w).to(model.w.dtype))
+    torch.save(model.state_dict(), output_path / f"{model_name}.pt")
+    with open(f"{model_name}.alphas", "w") as log_file:
+        log_file.write("\n".join(logs))
+    return selected_alphas
 
 def main():
     parser = ArgumentParser()
@@ -70,14 +352,66 @@ def main():
 
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     LOGGER.info(f"Using device {device}")
-    model = EntropyWhisper(config["checkpoint"]).to(device)
+    model = EntropyWhisper(config["checkpoint"],
+                           layer=config.get("layer"),
+                           probe=config.get("probe", False)).to(device)
     output_folder = Path(config["output_folder"])
     output_folder.mkdir(exist_ok=True, parents=True)
     data_loader = DataLoader(h5_file=config["h5_data"],
                              utterances=config["utterances"],
                              targets=config["targets"],
                              checkpoint=config["checkpoint"],
-                             sub_hours=config["sub_hours"])
+                             sub_hours=config["sub_hours"],
+                             variable_length=config.get("variable_length", False),
+                             max_duration=config.get("max_duration"),
+                             max_batch_seconds=config.get("max_batch_seconds"),
+                             bucket_width=config.get("bucket_width", 1.0),
+                             seed=config.get("seed", 1797),
+                             num_workers=config.get("num_workers", 0),
+                             prefetch=config.get("prefetch", 2),
+                             frontend=config.get("frontend", "processor"),
+                             durations=config.get("durations"),
+                             stratify=config.get("stratify"))
+    cache = None
+    if config.get("embeddings_cache") is not None:
+        cache = EmbeddingsCache(config["embeddings_cache"],
+                                config["checkpoint"],
+                                data_loader.features_name,
+                                model.pooling_name,
+                                sources_key(data_loader.audio.sources()))
+    solver = config.get("solver", "adam")
+    assert solver in {"adam", "ridge"}, f"Unknown solver {solver}"
+    instrumentation = None
+    if config.get("instrumentation", False):
+        instrumentation = Instrumentation(f"{config['model_name']}.stages.jsonl",
+                                          profile_steps=config.get("profile_steps"))
+    if config.get("sweep") is not None:
+        assert solver == "adam", "The sweep trains the heads with Adam."
+        sweep(model=model,
+              device=device,
+              output_path=output_folder,
+              data_loader=data_loader,
+              model_name=config["model_name"],
+              batch_size=config["batch_size"],
+              epochs=config["epochs"],
+              learning_rates=config["sweep"].get("learning_rate", [config["learning_rate"]]),
+              seeds=config["sweep"].get("seed", [config.get("seed", 1797)]),
+              cache=cache,
+              instrumentation=instrumentation)
+        return
+    if solver == "ridge":
+        ridge(model=model,
+              device=device,
+              output_path=output_folder,
+              data_loader=data_loader,
+              model_name=config["model_name"],
+              batch_size=config["batch_size"],
+              alphas=config.get("ridge_alphas", [0.1, 1.0, 10.0, 100.0, 1000.0]),
+              validation=config.get("ridge_validation", 0.1),
+              seed=config.get("seed", 1797),
+              cache=cache,
+              instrumentation=instrumentation)
+        return
     train(model=model,
           device=device,
           output_path=output_folder,
@@ -85,7 +419,9 @@ def main():
           model_name=config["model_name"],
           batch_size=config["batch_size"],
           epochs=config["epochs"],
-          lr=config["learning_rate"])
+          lr=config["learning_rate"],
+          cache=cache,
+          instrumentation=instrumentation)
 
 if __name__ == "__main__":
     main()
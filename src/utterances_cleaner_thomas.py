@@ -4,9 +4,31 @@
     markers. See the file markers.json to see what kinds of markers are /
     accounted.
 """
+from typing import List, Iterable
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from pathlib import Path
 import re
 import string
 import json
+import time
+import logging
+import pandas as pd
+import pylangacq
+
+LOGGER = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+_CLEANER = None
+
+def _load_cleaner(markers_json: str) -> None:
+    """Loads the cleaner of a process of the pool."""
+    global _CLEANER
+    _CLEANER = UtterancesCleaner(markers_json)
+
+def _clean(utterance: str) -> str:
+    """Cleans an utterance with the cleaner of the process."""
+    return _CLEANER.clean(utterance)
 
 class UtterancesCleaner :
     """
@@ -15,16 +37,20 @@ class UtterancesCleaner :
     or replacing them by other things.
     """
     def __init__(self, markers_json: str) :
+        self.markers_json = str(markers_json)
         with open(markers_json, encoding="UTF-8") as markers_file:
             markers = json.load(markers_file)
-        self.delete_marker_pattern = '|'.join(markers["marker_to_delete"])
-        self.word_contains_delete_pattern = '|'.join(markers["word_contains_delete"])
-        self.poncts_to_delete_pattern = '|'.join(markers["poncts_to_delete"])
-        self.delete_comments_pattern = r"(\(|\<|\*)(.+?)(\)|\>|\*)"
-        self.replace_unk_pattern = r"xxx|xx|yyy|yy|www|ww|[0-9]+|\*"
+        self.delete_marker_pattern = re.compile('|'.join(markers["marker_to_delete"]))
+        self.word_contains_delete_pattern = re.compile('|'.join(markers["word_contains_delete"]))
+        self.poncts_to_delete_pattern = re.compile('|'.join(markers["poncts_to_delete"]))
+        self.delete_comments_pattern = re.compile(r"(\(|\<|\*)(.+?)(\)|\>|\*)")
+        self.replace_unk_pattern = re.compile(r"xxx|xx|yyy|yy|www|ww|[0-9]+|\*")
         self.pattern_letter = re.compile(r"(\s?)([^ ]*)\s\[x (\d+)\]")
         self.pattern_repetition = re.compile(r"(\s?)([^ ]*)\s\[x (\d+)\]")
+        self.pattern_brackets = re.compile(r"[\(\[].*?[\)\]]")
+        self.pattern_spaces = re.compile(' +')
         self.punctuations = "".join(set(string.punctuation) - {"'"})
+        self.punctuations_table = str.maketrans('', '', self.punctuations)
 
     def replace_marker(self, utterance: str, pattern: str, replacement: str="∑") -> list:
         """
@@ -34,7 +60,7 @@ class UtterancesCleaner :
         ----------
         - utterance : str
             Utterance from which markers will be replaced
-        - pattern : str
+        - pattern : str, re.Pattern
             Regex pattern containing markers to delete from the utterance
         - replacement :
             Symbol that will replace markers
@@ -52,7 +78,7 @@ class UtterancesCleaner :
             Utterance from which those words will be removed
         """
         return " ".join(word for word in utterance.split(" ") \
-            if not re.match(self.word_contains_delete_pattern, word))
+            if not self.word_contains_delete_pattern.match(word))
 
     def remove_ponctuations(self, utterance: str) -> str :
         """
@@ -68,7 +94,7 @@ class UtterancesCleaner :
         str :
             The utterance without punctuations.
         """
-        return utterance.translate(str.maketrans('', '', self.punctuations))
+        return utterance.translate(self.punctuations_table)
 
     def remove_brackets(self, utterance: str) -> str :
         """
@@ -84,7 +110,7 @@ class UtterancesCleaner :
         str :
             The utterance without brackets.
         """
-        return re.sub(r"[\(\[].*?[\)\]]", '', utterance)
+        return self.pattern_brackets.sub('', utterance)
 
     def handle_repetitions(self, utterance: str) -> str:
         """
@@ -96,18 +122,20 @@ class UtterancesCleaner :
         utterance: str
             Utterance from which some units will be repeated.
         """
-        while True:
-            matched = re.search(self.pattern_repetition, utterance)
+        # a repetition can apply to the words repeated by the previous one,
+        # so the utterance is searched again after each repetition.
+        while "[x " in utterance:
+            matched = self.pattern_repetition.search(utterance)
 
             if not matched:
                 break
 
-            all_match = matched.group(0)
             separator = matched.group(1)
             word, repetitions = matched.group(2),matched.group(3)
             repeated_word = f"{separator}{' '.join([word] * int(repetitions))}"
 
-            utterance = utterance.replace(all_match, repeated_word, 1)
+            # the first occurrence of the match is the match itself
+            utterance = utterance[:matched.start()] + repeated_word + utterance[matched.end():]
 
         return utterance
 
@@ -126,13 +154,40 @@ class UtterancesCleaner :
         - str
             Utterance without multiple successive spaces.
         """
-        return re.sub(' +', ' ', utterance)
+        return self.pattern_spaces.sub(' ', utterance)
 
-    def clean(self, utterance: str) -> str :
+    def clean_words(self, utterance: str) -> str:
+        """
+        Applies the passes working word by word in a single loop\
+        over the words: deleting the markers, the words to delete,\
+        the ponctuations, the comments and the unknown words.
+        None of these passes changes the spaces, so applying them\
+        word after word gives the same words as applying them\
+        pass after pass.
 
+        Parameters
+        ----------
+        - utterance : str
+            Utterance from which the markers and words will be deleted.
         """
-        Method that clean utterances by deleting or replacing /
-        markers.
+        delete_marker = self.delete_marker_pattern.sub
+        word_contains_delete = self.word_contains_delete_pattern.match
+        poncts_to_delete = self.poncts_to_delete_pattern.sub
+        delete_comments = self.delete_comments_pattern.sub
+        replace_unk = self.replace_unk_pattern.sub
+        words = []
+        for word in utterance.split(" "):
+            word = delete_marker("", word)
+            if word_contains_delete(word):
+                continue
+            words.append(replace_unk("", delete_comments("", poncts_to_delete("", word))))
+        return " ".join(words)
+
+    def clean_stepwise(self, utterance: str) -> str :
+        """
+        Cleans an utterance pass after pass, as `clean` did before\
+        the word passes were merged. It gives the same output as `clean`\
+        and is kept as the reference of the benchmark.
 
         Parameters
         ----------
@@ -153,4 +208,110 @@ class UtterancesCleaner :
         utterance = self.remove_ponctuations(utterance)
         utterance = self.remove_multiple_spaces(utterance)
         utterance = utterance.strip()
-        return utterance
\ No newline at end of file
+        return utterance
+
+    def clean(self, utterance: str) -> str :
+
+        """
+        Method that clean utterances by deleting or replacing /
+        markers.
+
+        Parameters
+        ----------
+        - utterances : str
+            Utterance to clean
+        Returns
+        -------
+        - str
+            Cleaned utterance
+        """
+        utterance = self.handle_repetitions(utterance)
+        utterance = self.clean_words(utterance)
+        utterance = self.pattern_brackets.sub('', utterance)
+        utterance = utterance.translate(self.punctuations_table)
+        return self.pattern_spaces.sub(' ', utterance).strip()
+
+    def clean_many(self, utterances: Iterable[str], jobs: int=1, chunk_size: int=1000) -> List[str]:
+        """
+        Cleans many utterances, split across `jobs` processes\
+        by chunks of `chunk_size` utterances.
+
+        Parameters
+        ----------
+        - utterances : iterable of str
+            Utterances to clean
+        - jobs : int
+            The number of processes. Default=1
+        - chunk_size : int
+            The number of utterances sent at once to a process. Default=1000
+        Returns
+        -------
+        - list
+            Cleaned utterances, in the same order
+        """
+        if jobs <= 1:
+            return [self.clean(utterance) for utterance in utterances]
+        with Pool(jobs, initializer=_load_cleaner, initargs=(self.markers_json,)) as pool:
+            return pool.map(_clean, utterances, chunksize=chunk_size)
+
+def read_utterances(input_path: Path) -> List[str]:
+    """
+    Reads the utterances to benchmark: one utterance per line of a text\
+    file, or the transcriptions of the converted csvs of the Thomas corpus.
+    """
+    if not input_path.is_dir():
+        with open(input_path, encoding="UTF-8") as utterances_file:
+            return [line.rstrip("\n") for line in utterances_file]
+    utterances = []
+    for csv in sorted((input_path / "annotations" / "cha" / "converted").glob("*.csv")):
+        transcriptions = pd.read_csv(csv)["transcription"]
+        utterances.extend(pylangacq.chat._clean_utterance(utterance) for utterance in transcriptions)
+    return utterances
+
+def benchmark(cleaner: UtterancesCleaner, utterances: List[str], jobs: int=1, repeats: int=3) -> None:
+    """
+    Logs the throughput of the pass after pass cleaning, of `clean` and\
+    of `clean_many`, and checks that they give the same output.
+    """
+    def throughput(clean_all):
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            cleaned = clean_all()
+            timings.append(time.perf_counter() - start)
+        return cleaned, len(utterances) / min(timings)
+    reference, reference_throughput = throughput(lambda: [cleaner.clean_stepwise(u) for u in utterances])
+    cleaned, clean_throughput = throughput(lambda: [cleaner.clean(u) for u in utterances])
+    cleaned_many, many_throughput = throughput(lambda: cleaner.clean_many(utterances, jobs))
+    mismatches = sum(ref != new for ref, new in zip(reference, cleaned))
+    mismatches += sum(ref != new for ref, new in zip(reference, cleaned_many))
+    LOGGER.info(f"Pass after pass: {reference_throughput:.0f} utterances/s")
+    LOGGER.info(f"clean: {clean_throughput:.0f} utterances/s ({clean_throughput / reference_throughput:.2f}x)")
+    LOGGER.info(f"clean_many with {jobs} jobs: {many_throughput:.0f} utterances/s"\
+                f" ({many_throughput / reference_throughput:.2f}x)")
+    assert mismatches == 0, f"{mismatches} utterances are cleaned differently."
+    LOGGER.info(f"The {len(utterances)} utterances are cleaned identically.")
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("-i", "--input",
+                        help="A text file with one utterance per line, or the folder of the Thomas corpus.",
+                        required=True)
+    parser.add_argument("-m", "--markers",
+                        help="The json file of the markers.",
+                        default="extra/markers.json")
+    parser.add_argument("-j", "--jobs",
+                        help="The number of processes of `clean_many`.",
+                        type=int,
+                        default=1)
+    parser.add_argument("-r", "--repeats",
+                        help="The number of timings, the fastest being kept.",
+                        type=int,
+                        default=3)
+
+    args = parser.parse_args()
+    utterances = read_utterances(Path(args.input))
+    benchmark(UtterancesCleaner(args.markers), utterances, args.jobs, args.repeats)
+
+if __name__ == "__main__":
+    main()